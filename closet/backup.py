@@ -0,0 +1,62 @@
+"""
+Export and import of closets from the command line, in the formats of GET /export and POST /import.
+
+Reads and writes MongoDB directly (MONGO_URI and MONGO_DB like the service, or --mongo-uri and --db),
+streaming the records so closets of any size are copied with constant memory.
+Progress reports of the import are printed to stderr as JSON lines.
+
+Examples:
+    python backup.py export --owner alice --output alice.bson
+    python backup.py import --owner alice --input alice.bson
+    python backup.py export --owner alice | python backup.py import --owner bob --format ndjson
+"""
+import argparse
+import json
+import sys
+
+import pymongo
+
+import closet
+
+
+def open_stream(path, mode, default):
+    return open(path, mode) if path and path != '-' else default
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export and import of closets.')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('--owner', default=closet.DEFAULT_OWNER, help='closet exported or imported into')
+    parser.add_argument('--mongo-uri', default=closet.MONGO_URI)
+    parser.add_argument('--db', default=closet.MONGO_DB)
+    parser.add_argument('--format', choices=list(closet.EXPORT_FORMATS),
+                        help='format of the records, from the file extension by default (ndjson otherwise)')
+    parser.add_argument('--input', help='file imported, stdin by default')
+    parser.add_argument('--output', help='file exported to, stdout by default')
+    parser.add_argument('--batch-size', type=int, default=closet.IMPORT_BATCH_SIZE, help='records per bulk write')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    path = args.input if args.command == 'import' else args.output
+    export_format = args.format or ('bson' if path and path.endswith('.bson') else 'ndjson')
+    closet.connect_database(pymongo.MongoClient(args.mongo_uri), args.db)
+
+    if args.command == 'export':
+        with open_stream(path, 'wb', sys.stdout.buffer) as file:
+            for chunk in closet.encode_records(closet.export_closet(args.owner), export_format):
+                file.write(chunk)
+        return 0
+
+    # The unique indexes keep the restored closet consistent
+    closet.prepare_database()
+    with open_stream(path, 'rb', sys.stdin.buffer) as file:
+        records = closet.decode_records(file, export_format)
+        for report in closet.ClosetImport(args.owner, args.batch_size).run(records):
+            print(json.dumps(report), file=sys.stderr)
+    return 1 if 'error' in report or report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
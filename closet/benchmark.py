@@ -0,0 +1,436 @@
+"""
+Load benchmark of the closet service.
+
+Boots closet.py in-process against a local MongoDB (or mongomock as an in-process stand-in for read-only mixes),
+points OpenWeatherMap, ipinfo.io and the photo URLs at a local stub server with injected latency,
+seeds closets of the requested sizes and replays a mixed workload against them.
+Throughput and p50/p95/p99 latencies per endpoint are printed as JSON.
+
+Example:
+    python benchmark.py --mongo-uri mongodb://localhost:27017/ --sizes 1000,100000 --duration 30
+
+The benchmark drops and re-creates its database (--db, "ClosetBenchmark" by default) for every size,
+never point it at the production database.
+"""
+import argparse
+import ipaddress
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pymongo
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import closet
+
+# Share of each request of the workload
+DEFAULT_MIX = {
+    'GET /clothes': 35,
+    'GET /outfits': 30,
+    'POST /ratings/<id>': 20,
+    'GET /top': 10,
+    'POST /clothes': 5,
+}
+
+# Statuses of a working request, any other status is counted as an error
+EXPECTED_STATUSES = {
+    'GET /clothes': {200},
+    'GET /outfits': {200, 404},  # 404 when no outfit matches the weather
+    'POST /ratings/<id>': {201},
+    'GET /top': {200},
+    'POST /clothes': {201, 202},
+}
+
+SEED_BATCH_SIZE = 10000  # documents per insert_many
+OUTFIT_TYPES = ['Shirt', 'Long Pants', 'Shoes']  # pieces of the seeded outfits
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like OpenWeatherMap (/data/2.5/weather), ipinfo.io (/json and /<ip>/json)
+    and an image host (/images/...), after sleeping the injected latency of the service.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/data/2.5/weather'):
+            self.delay(self.server.latencies['weather'])
+            params = parse_qs(urlparse(self.path).query)
+            latitude = float(params.get('lat', ['0'])[0])
+            # Deterministic weather per location so the cached answers stay consistent
+            condition = ['Clear', 'Clouds', 'Rain', 'Snow'][int(abs(latitude) * 10) % 4]
+            self.send_json({'weather': [{'main': condition}], 'main': {'temp': abs(latitude) % 40}})
+        elif path.endswith('/json'):
+            self.delay(self.server.latencies['ipinfo'])
+            ip = path.strip('/').split('/')[0] if path != '/json' else '8.8.8.8'
+            octets = [int(part) for part in ip.split('.')] if '.' in ip else [8, 8, 8, 8]
+            self.send_json({'loc': f'{octets[0] % 180 - 90 + octets[1] / 256:.4f},{octets[2] * 1.4 - 180:.4f}'})
+        elif path.startswith('/images/'):
+            self.delay(self.server.latencies['image'])
+            self.send_body(b'\x89', 'image/png')
+        else:
+            self.send_body(b'', 'text/plain', status=404)
+
+    def do_HEAD(self):
+        if urlparse(self.path).path.startswith('/images/'):
+            self.delay(self.server.latencies['image'])
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', '1')
+            self.end_headers()
+        else:
+            self.send_body(b'', 'text/plain', status=404)
+
+    def delay(self, latency):
+        if latency:
+            time.sleep(latency + random.uniform(0, self.server.jitter))
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data).encode(), 'application/json')
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_stub_server(latencies, jitter):
+    """
+    Starts the stub of the external APIs on a free local port, returns its base URL.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.latencies = latencies
+    server.jitter = jitter
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def start_app_server():
+    """
+    Serves the closet app with the threaded werkzeug server on a free local port, returns its base URL.
+    """
+    server = make_server('127.0.0.1', 0, closet.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def connect(mongo_uri):
+    if mongo_uri.startswith('mongomock://'):
+        # The in-process stand-in is handy without a server but only for reads (see parse_args),
+        # its numbers are only comparable with each other
+        import mongomock
+        return mongomock.MongoClient()
+    return pymongo.MongoClient(mongo_uri)
+
+
+def clear_caches():
+    for cache in (closet.response_cache, closet.weather_cache, closet.location_cache,
+                  closet.url_validation_cache, closet.piece_scores_cache):
+        cache.clear()
+
+
+def insert_batches(collection, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == SEED_BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def seed(database, items, outfits, owners, stub_url, rng):
+    """
+    Seeds items clothing pieces and outfits outfits (with their ratings) shaped like the documents the API writes,
+    spread over the closets of the owners. Returns the (owner, outfit id) pairs.
+    """
+    types = closet.ACCEPTED_TYPES
+    piece_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(items)]
+
+    # Pieces come in groups of one piece of each type, the groups are dealt to the owners in turn
+    def piece_owner(index):
+        return owners[index // len(types) % len(owners)]
+
+    def pieces():
+        for index, piece_id in enumerate(piece_ids):
+            yield {
+                'owner': piece_owner(index),
+                'id': piece_id,
+                'type': types[index % len(types)],
+                'color': rng.choice(['red', 'blue', 'black', 'white', 'green']),
+                'waterProof': rng.random() < 0.2,
+                'photo': f'{stub_url}/images/{piece_id}.png'
+            }
+
+    insert_batches(database['Clothes'], pieces())
+
+    # Pieces of each type of the seeded outfits, the type of piece i is types[i % len(types)]
+    groups_per_owner = max(items // len(types) // len(owners), 1)
+    outfit_ids = [(owners[index % len(owners)], str(uuid.UUID(int=rng.getrandbits(128)))) for index in range(outfits)]
+
+    def outfit_pieces(owner):
+        selected = []
+        for piece_type in OUTFIT_TYPES:
+            group = rng.randrange(groups_per_owner) * len(owners) + owners.index(owner)
+            piece_index = group * len(types) + types.index(piece_type)
+            if piece_index < items:
+                selected.append({'id': piece_ids[piece_index], 'type': piece_type,
+                                 'photo': f'{stub_url}/images/{piece_ids[piece_index]}.png'})
+        return selected
+
+    def outfit_documents(ratings):
+        for owner, outfit_id in outfit_ids:
+            selected = outfit_pieces(owner)
+            photos = [piece['photo'] for piece in selected]
+            yield {
+                'owner': owner,
+                'id': outfit_id,
+                'style': rng.choice(closet.ACCEPTED_STYLES),
+                'waterproof': rng.random() < 0.3,
+                'clothingItems': [{'type': piece['type'], 'photo': piece['photo']} for piece in selected],
+                'pieceIds': [piece['id'] for piece in selected],
+                'suitableWeathers': rng.choice(closet.ACCEPTED_WEATHERS),
+                'outfitPhoto': photos
+            }
+            ratings.append(rating_document(owner, outfit_id, photos, rng))
+
+    ratings = []
+    insert_batches(database['Outfits'], outfit_documents(ratings))
+    insert_batches(database['Ratings'], ratings)
+    return outfit_ids
+
+
+def rating_document(owner, outfit_id, photos, rng):
+    rating = {'owner': owner, 'id': outfit_id, 'pictures': photos}
+    scores = [rng.randint(0, 10) for _ in range(rng.choice([0, 1, 3, 10]))]
+    if scores:
+        histogram = {}
+        for score in scores:
+            histogram[str(score)] = histogram.get(str(score), 0) + 1
+        rating.update({
+            'count': len(scores),
+            'sum': sum(scores),
+            'sumSquares': sum(score * score for score in scores),
+            'histogram': histogram,
+            'average': sum(scores) / len(scores)
+        })
+    return rating
+
+
+def client_ips(count, rng):
+    """
+    Public IPv4 addresses the simulated users send their requests from.
+    """
+    ips = []
+    while len(ips) < count:
+        ip = ipaddress.IPv4Address(rng.getrandbits(32))
+        if ip.is_global:
+            ips.append(str(ip))
+    return ips
+
+
+def make_request(session, app_url, name, outfit_ids, ips, stub_url, rng):
+    owner, outfit_id = rng.choice(outfit_ids)
+    headers = {'X-Forwarded-For': rng.choice(ips), closet.OWNER_HEADER: owner}
+    if name == 'GET /clothes':
+        params = {'type': rng.choice(closet.ACCEPTED_TYPES), 'limit': 50}
+        return session.get(f'{app_url}/clothes', params=params, headers=headers)
+    if name == 'GET /outfits':
+        params = {'style': rng.choice(closet.ACCEPTED_STYLES), 'limit': 50}
+        return session.get(f'{app_url}/outfits', params=params, headers=headers)
+    if name == 'POST /ratings/<id>':
+        return session.post(f'{app_url}/ratings/{outfit_id}', json={'score': rng.randint(0, 10)},
+                            headers=headers)
+    if name == 'GET /top':
+        return session.get(f'{app_url}/top', params={'k': rng.choice([3, 10, 50])}, headers=headers)
+    if name == 'POST /clothes':
+        piece = {'type': rng.choice(closet.ACCEPTED_TYPES), 'color': 'red',
+                 'photo': f'{stub_url}/images/new-{uuid.uuid4()}.png'}
+        return session.post(f'{app_url}/clothes', json=piece, headers=headers)
+    raise ValueError(f'unknown request {name}')
+
+
+def run_workload(app_url, stub_url, outfit_ids, ips, mix, concurrency, duration, warmup, seed_value):
+    """
+    Replays the mix with concurrency clients for duration seconds, after warmup seconds that aren't recorded.
+    Returns the latencies (seconds) and the statuses per request name, and the measured duration.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    statuses = {name: {} for name in names}
+    lock = threading.Lock()
+    start = time.monotonic()
+    record_from = start + warmup
+    stop_at = record_from + duration
+
+    def client(index):
+        rng = random.Random(seed_value * 1000 + index)
+        with requests.Session() as session:
+            while True:
+                name = rng.choices(names, weights)[0]
+                request_start = time.monotonic()
+                if request_start >= stop_at:
+                    return
+                try:
+                    status = str(make_request(session, app_url, name, outfit_ids, ips, stub_url, rng).status_code)
+                except requests.RequestException:
+                    status = 'connection error'
+                elapsed = time.monotonic() - request_start
+                if request_start >= record_from:
+                    with lock:
+                        latencies[name].append(elapsed)
+                        statuses[name][status] = statuses[name].get(status, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    return latencies, statuses, min(time.monotonic(), stop_at) - record_from
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 3)
+
+
+def summarize(latencies, statuses, duration):
+    endpoints = {}
+    total = 0
+    for name, values in latencies.items():
+        values.sort()
+        total += len(values)
+        errors = sum(count for status, count in statuses[name].items()
+                     if not status.isdigit() or int(status) not in EXPECTED_STATUSES[name])
+        endpoints[name] = {
+            'requests': len(values),
+            'throughput': round(len(values) / duration, 2) if duration else None,
+            'errors': errors,
+            'statuses': statuses[name],
+            'p50_ms': percentile(values, 0.50),
+            'p95_ms': percentile(values, 0.95),
+            'p99_ms': percentile(values, 0.99),
+        }
+    return {'requests': total, 'throughput': round(total / duration, 2) if duration else None, 'endpoints': endpoints}
+
+
+def parse_mix(value):
+    """
+    Parses a mix like "GET /clothes=50,GET /top=50".
+    """
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.rpartition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown request {name!r}, expected one of {list(DEFAULT_MIX)}')
+        mix[name] = float(weight)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load benchmark of the closet service.')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/',
+                        help='MongoDB to benchmark against, mongomock:// for the in-process stand-in')
+    parser.add_argument('--db', default='ClosetBenchmark', help='database dropped and seeded for every size')
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated numbers of clothing items to seed')
+    parser.add_argument('--outfits-ratio', type=float, default=0.5, help='seeded outfits per clothing item')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of recorded load per size')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of unrecorded load before')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--client-ips', type=int, default=1000, help='distinct client IP addresses')
+    parser.add_argument('--owners', type=int, default=1, help='closets the seeded items are spread over')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='request weights, e.g. "GET /clothes=50,GET /top=50"')
+    parser.add_argument('--weather-latency', type=float, default=100, help='OpenWeatherMap stub latency in ms')
+    parser.add_argument('--ipinfo-latency', type=float, default=50, help='ipinfo.io stub latency in ms')
+    parser.add_argument('--image-latency', type=float, default=80, help='image host stub latency in ms')
+    parser.add_argument('--jitter', type=float, default=10, help='random extra latency of the stubs in ms')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the data and of the workload')
+    parser.add_argument('--output', help='file the JSON report is written to, stdout by default')
+    args = parser.parse_args(argv)
+
+    # mongomock's bulk writes and update pipelines don't match the pinned pymongo, every write would fail
+    writes = [name for name, weight in args.mix.items() if weight and not name.startswith('GET ')]
+    if args.mongo_uri.startswith('mongomock://') and writes:
+        parser.error(f'mongomock:// only runs read-only mixes, {writes} need a real MongoDB '
+                     '(e.g. --mix "GET /clothes=40,GET /outfits=40,GET /top=20")')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    latencies = {'weather': args.weather_latency / 1000, 'ipinfo': args.ipinfo_latency / 1000,
+                 'image': args.image_latency / 1000}
+    stub_url = start_stub_server(latencies, args.jitter / 1000)
+
+    # Send the external calls of the app to the stubs
+    closet.OPENWEATHER_URL = f'{stub_url}/data/2.5/weather'
+    closet.IPINFO_URL = f'{stub_url}/json'
+    closet.IPINFO_IP_URL = stub_url + '/{}/json'
+    closet.geoip_db = None
+    # The clients send X-Forwarded-For like a single proxy would
+    closet.TRUSTED_PROXY_COUNT = 1
+
+    client = connect(args.mongo_uri)
+    app_url = start_app_server()
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'output'}, 'runs': []}
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        rng = random.Random(args.seed)
+        client.drop_database(args.db)
+        database = client[args.db]
+        closet.connect_database(client, args.db)
+        clear_caches()
+
+        print(f'Seeding {size} items...', file=sys.stderr)
+        seed_start = time.monotonic()
+        owners = [closet.DEFAULT_OWNER] if args.owners == 1 else [f'user{index}' for index in range(args.owners)]
+        outfit_ids = seed(database, size, max(int(size * args.outfits_ratio), 1), owners, stub_url, rng)
+        closet.ensure_indexes()
+        seed_seconds = time.monotonic() - seed_start
+
+        print(f'Running the workload for {args.warmup + args.duration}s...', file=sys.stderr)
+        results = run_workload(app_url, stub_url, outfit_ids, client_ips(args.client_ips, rng), args.mix,
+                               args.concurrency, args.duration, args.warmup, args.seed)
+        run = {'items': size, 'outfits': len(outfit_ids), 'owners': len(owners), 'seed_seconds': round(seed_seconds, 2)}
+        run.update(summarize(*results))
+        run['caches'] = {name: cache.stats() for name, cache in {
+            'response': closet.response_cache,
+            'weather': closet.weather_cache,
+            'location': closet.location_cache,
+            'url_validation': closet.url_validation_cache,
+        }.items()}
+        report['runs'].append(run)
+
+    client.drop_database(args.db)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,1025 @@
+import bson
 import pymongo
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_restful import Api, Resource
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+import ipaddress
+import os
 import requests
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import json
+import random
+import threading
+import time
 import uuid
 
+# Optional faster JSON encoder and brotli compression, the stdlib json module and gzip are used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 api = Api(app)
 
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    return default if value is None else value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Metrics setup: upper bounds of the latency histogram buckets, in seconds
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of counters, gauges and latency histograms, rendered in the Prometheus text format.
+    Series are keyed by their name and a tuple of (label, value) pairs.
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self._types = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._types[name] = 'counter'
+            self._values[(name, labels)] = self._values.get((name, labels), 0) + value
+
+    def add(self, name, labels=(), value=1):
+        with self._lock:
+            self._types[name] = 'gauge'
+            self._values[(name, labels)] = self._values.get((name, labels), 0) + value
+
+    def set(self, name, labels, value, kind='gauge'):
+        with self._lock:
+            self._types[name] = kind
+            self._values[(name, labels)] = value
+
+    def observe(self, name, labels, seconds):
+        # One count per bucket (not cumulative until rendered), then the total count and sum
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._types[name] = 'histogram'
+            histogram = self._values.get((name, labels))
+            if histogram is None:
+                histogram = self._values[(name, labels)] = [0] * (len(self.buckets) + 2) + [0.0]
+            histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(value) if isinstance(value, list) else value)
+                            for key, value in self._values.items())
+            types = dict(self._types)
+
+        lines = []
+        current_name = None
+        for (name, labels), value in values:
+            if name != current_name:
+                lines.append(f'# TYPE {name} {types[name]}')
+                current_name = name
+            if types[name] != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-2]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+class MongoCommandMetrics(pymongo.monitoring.CommandListener):
+    """
+    Records the latency and the failures of every command sent to MongoDB.
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe('closet_mongo_command_duration_seconds',
+                        (('command', event.command_name),), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = (('command', event.command_name),)
+        metrics.observe('closet_mongo_command_duration_seconds', labels, event.duration_micros / 1e6)
+        metrics.inc('closet_mongo_command_errors_total', labels)
+
+
+metrics = MetricsRegistry(METRICS_BUCKETS)
+pymongo.monitoring.register(MongoCommandMetrics())
+
+
+def instrument_request(view):
+    """
+    Records the latency, the status and the number of in-flight requests of every resource method.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        labels = (('endpoint', request.endpoint), ('method', request.method))
+        metrics.add('closet_http_requests_in_flight', labels)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = view(*args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            metrics.add('closet_http_requests_in_flight', labels, -1)
+            metrics.observe('closet_http_request_duration_seconds', labels, time.perf_counter() - start)
+            metrics.inc('closet_http_requests_total', labels + (('status', str(status)),))
+    return wrapper
+
+
+def instrument_call(metric, name, failed=lambda result: False):
+    """
+    Records the latency of a function under the given name, and counts the calls whose result is a failure.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            labels = ((metric, name),)
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                metrics.inc(f'closet_{metric}_errors_total', labels)
+                raise
+            finally:
+                metrics.observe(f'closet_{metric}_duration_seconds', labels, time.perf_counter() - start)
+            if failed(result):
+                metrics.inc(f'closet_{metric}_errors_total', labels)
+            return result
+        return wrapper
+    return decorator
+
+
+api.decorators.append(instrument_request)
+
+# MongoDB setup, every setting can be overridden with the environment variable of the same name
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://mongo:27017/')
+MONGO_DB = os.environ.get('MONGO_DB', 'Closet')
+MONGO_MAX_POOL_SIZE = env_int('MONGO_MAX_POOL_SIZE', 32)  # connections per worker process
+MONGO_MIN_POOL_SIZE = env_int('MONGO_MIN_POOL_SIZE', 2)
+MONGO_MAX_IDLE_TIME_MS = env_int('MONGO_MAX_IDLE_TIME_MS', 60000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+
+
+def connect_database(mongo_client=None, database=None):
+    """
+    Creates the MongoDB client of this process and binds the collections to it.
+    A client can't be shared across a fork, so pre-fork servers call it again in every worker.
+    """
+    global client, db, clothes_collection, outfits_collection, ratings_collection, \
+        rating_scores_collection, versions_collection, photo_validations_collection
+    client = mongo_client or pymongo.MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS
+    )
+    db = client[database or MONGO_DB]
+    clothes_collection = db["Clothes"]
+    outfits_collection = db["Outfits"]
+    ratings_collection = db["Ratings"]
+    rating_scores_collection = db["RatingScores"]  # append-only log of the raw scores
+    versions_collection = db["Versions"]  # version counter of each collection, shared by all the workers
+    photo_validations_collection = db["PhotoValidations"]  # queue of the photos validated in the background
+
+
 # Connect to MongoDB
-client = pymongo.MongoClient("mongodb://mongo:27017/")
-db = client["Closet"]
-clothes_collection = db["Clothes"]
-outfits_collection = db["Outfits"]
-ratings_collection = db["Ratings"]
-clothes_ids = db["ClothesIds"]
+connect_database()
+
+# Multi-tenancy setup: every document has an owner and every request works on the closet of one owner,
+# given by the OWNER_HEADER header (set by the authenticating proxy). Requests without it use DEFAULT_OWNER
+# unless REQUIRE_OWNER is set. All the indexes lead with owner, so the collections can be sharded on it.
+OWNER_HEADER = os.environ.get('OWNER_HEADER', 'X-Owner-Id')
+DEFAULT_OWNER = os.environ.get('DEFAULT_OWNER', 'default')
+REQUIRE_OWNER = env_bool('REQUIRE_OWNER', False)
+OWNER_MAX_LENGTH = 128
+OWNERLESS_ENDPOINTS = ['liveness', 'readiness', 'metrics', 'weathercachestats']
+MONGO_SHARDING = env_bool('MONGO_SHARDING', False)  # shard the collections on owner at startup (through mongos)
+HIDDEN_FIELDS = {'_id': 0, 'owner': 0}  # projection of the documents returned to the clients
+
+# Accepted clothing types and outfit values
+ACCEPTED_TYPES = ['Dress', 'Shirt', 'Long Pants', 'Short Pants', 'Skirt', 'Shoes', 'Jacket', 'Bag', 'Hat',
+                  'Belt', 'Scarf', 'SunGlasses']
+ACCEPTED_STYLES = ['Casual', 'Elegant', 'Sporty', 'Party', 'Work']
+ACCEPTED_WEATHERS = ['Cold', 'Mild', 'Hot']
+VALIDATE_MAX_OUTFITS = 1000  # max number of outfits in one POST /outfits/validate
 
 # OpenWeatherMap API setup
-OPENWEATHER_API_KEY = 'insert_here_your_openweather_api_key'
-OPENWEATHER_URL = 'https://api.openweathermap.org/data/2.5/weather'
-IPINFO_URL = 'https://ipinfo.io/json'
+OPENWEATHER_API_KEY = os.environ.get('OPENWEATHER_API_KEY', 'insert_here_your_openweather_api_key')
+OPENWEATHER_URL = os.environ.get('OPENWEATHER_URL', 'https://api.openweathermap.org/data/2.5/weather')
+IPINFO_URL = os.environ.get('IPINFO_URL', 'https://ipinfo.io/json')
+IPINFO_IP_URL = os.environ.get('IPINFO_IP_URL', 'https://ipinfo.io/{}/json')
+
+# Geolocation setup: an optional offline CSV database with "network,latitude,longitude" columns
+# (e.g. GeoLite2-City-Blocks-IPv4.csv), API lookups are cached per /24 (IPv4) or /48 (IPv6) prefix
+GEOIP_DB_PATH = os.environ.get('GEOIP_DB_PATH')
+GEOIP_CACHE_TTL = env_float('GEOIP_CACHE_TTL', 3600)  # seconds
+GEOIP_CACHE_SIZE = env_int('GEOIP_CACHE_SIZE', 10000)  # max number of prefixes kept
+
+# Number of reverse proxies in front of the app, each appends the address it received the request from
+# to X-Forwarded-For. With none the header is ignored, since the caller can send anything in it.
+TRUSTED_PROXY_COUNT = env_int('TRUSTED_PROXY_COUNT', 0)
+
+# HTTP client setup for the external APIs
+HTTP_TIMEOUT = (2, 3)  # (connect, read) seconds
+HTTP_POOL_SIZE = env_int('HTTP_POOL_SIZE', 32)  # keep-alive connections kept per host
+
+# Image URL validation setup: valid and invalid results are remembered for different times
+URL_VALIDATION_TIMEOUT = (2, 3)  # (connect, read) seconds
+URL_VALID_TTL = 24 * 3600  # seconds
+URL_INVALID_TTL = 300  # seconds
+URL_CACHE_SIZE = 10000
+SKIP_URL_VALIDATION = env_bool('SKIP_URL_VALIDATION', False)  # only check the URL format, for trusted bulk ingest
+
+# Asynchronous photo validation setup: with ASYNC_PHOTO_VALIDATION, POST /clothes and PUT /clothes/<id> answer 202
+# and the photo is validated in the background, meanwhile the piece is 'pending' and can't be used in outfits
+ASYNC_PHOTO_VALIDATION = env_bool('ASYNC_PHOTO_VALIDATION', False)
+PHOTO_VALIDATION_WORKERS = env_int('PHOTO_VALIDATION_WORKERS', 8)  # photos validated concurrently per process
+PHOTO_VALIDATION_POLL_INTERVAL = 1  # seconds between polls of an empty queue
+PHOTO_VALIDATION_LEASE = 60  # seconds a claimed job stays hidden from the other workers
+PHOTO_VALIDATION_MAX_ATTEMPTS = 5  # unreachable photos are marked invalid after that many attempts
+PHOTO_VALIDATION_BACKOFF = 5  # seconds before the first retry, doubled at every attempt
+PHOTO_VALIDATION_MAX_BACKOFF = 300  # seconds
+# Pieces that can be listed and used in outfits, pieces without a status were validated synchronously
+VALIDATED_PIECES = {'validation': {'$nin': ['pending', 'invalid']}}
+
+# Ratings setup: a rating keeps running aggregates (count, sum, sumSquares, histogram),
+# the raw scores are only appended to the RatingScores log when LOG_RATING_SCORES is set
+LOG_RATING_SCORES = env_bool('LOG_RATING_SCORES', True)
+
+# Leaderboard setup
+TOP_OUTFITS_DEFAULT_K = 3
+TOP_OUTFITS_MAX_K = 100
+
+# Response cache setup: cached GET responses are dropped when a collection they read changes
+RESPONSE_CACHE_SIZE = env_int('RESPONSE_CACHE_SIZE', 1024)
+RESPONSE_CACHE_MAX_BYTES = env_int('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)  # encoded bodies kept per process
+RESPONSE_CACHE_MAX_ENTRY_BYTES = env_int('RESPONSE_CACHE_MAX_ENTRY_BYTES', 1024 * 1024)  # larger bodies aren't cached
+RESPONSE_CACHE_TTL = env_float('RESPONSE_CACHE_TTL', 300)  # seconds
+VERSION_SYNC_INTERVAL = env_float('VERSION_SYNC_INTERVAL', 1)  # seconds between reads of the versions written by the other workers
+VERSION_CACHE_SIZE = 10000  # max number of (owner, collection) versions kept
+
+# Outfit generation setup
+GENERATE_DEFAULT_LIMIT = 10
+GENERATE_MAX_LIMIT = 100
+GENERATE_TIME_BUDGET = 0.5  # seconds, default search time of GET /outfits/generate
+GENERATE_MAX_TIME_BUDGET = 5  # seconds
+PIECE_SCORES_TTL = 60  # seconds the piece scores derived from the ratings are reused
+PIECE_SCORES_CACHE_SIZE = 1024  # max number of closets whose piece scores are kept
+# Score adjustments of each clothing type for the current weather
+WEATHER_PREFERENCES = {
+    'Cold': {'Long Pants': 1, 'Jacket': 1, 'Scarf': 0.5, 'Hat': 0.5, 'Short Pants': -1, 'Skirt': -0.5},
+    'Mild': {},
+    'Hot': {'Short Pants': 1, 'Skirt': 0.5, 'SunGlasses': 0.5, 'Hat': 0.5, 'Long Pants': -0.5, 'Jacket': -1}
+}
+
+# Outfit index setup: an optional in-process copy of each closet's outfits grouped by (weather, waterproof, style),
+# that GET /outfits reads instead of querying MongoDB
+OUTFIT_INDEX = env_bool('OUTFIT_INDEX', False)
+OUTFIT_INDEX_MAX_OUTFITS = env_int('OUTFIT_INDEX_MAX_OUTFITS', 200000)  # outfits kept per worker over all the closets
+OUTFIT_INDEX_MAX_CLOSET = 10000  # larger closets are left to MongoDB
+
+# Pagination setup
+PAGE_MAX_LIMIT = 1000  # max number of documents in one page
+PAGE_PARAMS = ['limit', 'after', 'fields']  # query parameters that aren't document filters
+
+# Search setup: GET /clothes/search filters on any values of the facets and counts the pieces of each value
+SEARCH_FACETS = ['type', 'color', 'waterProof']
+SEARCH_SORTS = ['id', 'type', 'color']  # each one is backed by an index on (owner, sort, id)
+
+# Bulk ingest setup
+BULK_MAX_ITEMS = 5000  # max number of pieces in one POST /clothes/bulk
+BULK_VALIDATION_WORKERS = 16  # photo URLs validated concurrently
+# Only deployments doing trusted ingest honor ?skipValidation=true on POST /clothes/bulk
+BULK_ALLOW_SKIP_VALIDATION = env_bool('BULK_ALLOW_SKIP_VALIDATION', False)
+
+# Export/import setup: a closet is streamed as {"collection": ..., "document": ...} records, as NDJSON or BSON,
+# the pieces first, then the outfits, then the ratings
+EXPORT_COLLECTIONS = ['clothes', 'outfits', 'ratings']  # in the order they're written and imported
+EXPORT_BATCH_SIZE = 1000  # documents per cursor batch
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'bson': 'application/bson'}
+IMPORT_BATCH_SIZE = env_int('IMPORT_BATCH_SIZE', 1000)  # records per round of bulk writes
+IMPORT_MAX_ERRORS = 100  # errors listed in the import report, the others are only counted
+
+# Response encoding setup: bodies of at least COMPRESSION_MIN_SIZE bytes are compressed with brotli or gzip,
+# whichever the client accepts (brotli is preferred when the brotli package is installed)
+COMPRESSION_MIN_SIZE = env_int('COMPRESSION_MIN_SIZE', 1024)  # bytes
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # 0-11, low qualities compress dynamic responses much faster
+COMPRESSIBLE_TYPES = ['application/json', 'text/plain', 'text/csv']
+
+# Weather cache setup: lat/lon are rounded to WEATHER_BUCKET_DIGITS decimals (1 digit ~ 11km)
+WEATHER_CACHE_TTL = env_float('WEATHER_CACHE_TTL', 600)  # seconds
+WEATHER_CACHE_SIZE = env_int('WEATHER_CACHE_SIZE', 1024)  # max number of location buckets kept
+WEATHER_BUCKET_DIGITS = 1
+
+# Weather prefetch setup: each worker refreshes the weather of its most requested buckets before it expires,
+# and keeps serving the last weather of a bucket for WEATHER_STALE_TTL more seconds while it's being refreshed
+WEATHER_PREFETCH = env_bool('WEATHER_PREFETCH', False)
+WEATHER_PREFETCH_MAX_LOCATIONS = env_int('WEATHER_PREFETCH_MAX_LOCATIONS', 256)  # buckets tracked per worker
+WEATHER_PREFETCH_CALLS_PER_MINUTE = env_int('WEATHER_PREFETCH_CALLS_PER_MINUTE', 60)  # upstream calls per worker
+WEATHER_PREFETCH_WINDOW = (0.75, 0.9)  # a refresh happens at a random point of this share of the TTL
+WEATHER_PREFETCH_RETRY = 30  # seconds before a failed refresh is tried again
+WEATHER_PREFETCH_DECAY_INTERVAL = 60  # seconds between halvings of the request counts
+WEATHER_PREFETCH_TICK = 1  # seconds between checks for due refreshes
+WEATHER_STALE_TTL = env_float('WEATHER_STALE_TTL', 600) if WEATHER_PREFETCH else 0  # seconds
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a time-to-live (in seconds).
+    Bounded by its number of entries and, when maxbytes is given, by the total size the entries are set with.
+    Keeps hit/miss counters so the cache hit ratio can be reported.
+    """
+    def __init__(self, maxsize, ttl, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None, size=0):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires_at)
+            self._sizes[key] = size
+            self._bytes += size
+            # Evict the least recently used entries
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self._bytes > self.maxbytes):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        if self._data.pop(key, None) is not None:
+            self._bytes -= self._sizes.pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'bytes': self._bytes,
+                'ttl': self.ttl
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the function,
+    the others wait for its result instead of sending the same upstream request.
+    If the function raises, every caller gets the exception.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not is_leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args)
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+class CollectionVersions:
+    """
+    Version counters of each owner's collections, bumped by every write.
+    The counters live in the Versions collection (one document per owner and collection) so the workers
+    see each other's writes, they are re-read at most every sync_interval seconds and right after a local write.
+    """
+    def __init__(self, sync_interval, maxsize):
+        self._versions = TTLCache(maxsize, sync_interval)
+
+    def bump(self, owner, *names):
+        versions_collection.bulk_write([
+            pymongo.UpdateOne({'_id': f'{name}:{owner}'}, {'$inc': {'version': 1}}, upsert=True) for name in names
+        ], ordered=False)
+        for name in names:
+            self._versions.delete((owner, name))
+
+    def get(self, owner, names):
+        versions = {name: self._versions.get((owner, name)) for name in names}
+        missing = [name for name, version in versions.items() if version is None]
+        if missing:
+            stored = {version['_id']: version['version'] for version in
+                      versions_collection.find({'_id': {'$in': [f'{name}:{owner}' for name in missing]}})}
+            for name in missing:
+                versions[name] = stored.get(f'{name}:{owner}', 0)
+                self._versions.set((owner, name), versions[name])
+        return tuple(versions[name] for name in names)
+
+
+collection_versions = CollectionVersions(VERSION_SYNC_INTERVAL, VERSION_CACHE_SIZE)
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+
+def cached_response(*names):
+    """
+    Caches the responses of a GET handler until one of the named collections changes,
+    and answers with 304 Not Modified when the request's If-None-Match matches the ETag.
+    Bodies are kept encoded, those over RESPONSE_CACHE_MAX_ENTRY_BYTES aren't kept.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            # Streamed responses aren't cached
+            if wants_ndjson():
+                return method(self, *args, **kwargs)
+
+            # The versions are read first, so a write made while the response is computed isn't missed
+            owner = current_owner()
+            key = (owner, request.path, request.query_string, collection_versions.get(owner, names))
+            cached = response_cache.get(key)
+            if cached is None:
+                result = method(self, *args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+                body, status, headers = (tuple(result) + ({},))[:3] if isinstance(result, tuple) else (result, 200, {})
+                data = dumps_json(body) + b'\n'
+                digest = hashlib.sha1(data).hexdigest()
+                cached = (data, status, dict(headers, ETag=f'"{digest}"'), digest)
+                if status < 500 and len(data) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                    response_cache.set(key, cached, size=len(data))
+
+            data, status, headers, digest = cached
+            # Compressed responses carry a weak ETag, which If-None-Match compares equal to the strong one
+            if status == 200 and request.if_none_match.contains_weak(digest):
+                return Response(status=304, headers={'ETag': headers['ETag']})
+            return Response(data, status=status, headers=headers, mimetype='application/json')
+        return wrapper
+    return decorator
+
+
+def dumps_json(data):
+    """
+    Serializes data to JSON bytes, with orjson when it's installed.
+    """
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data).encode()
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    response = Response(dumps_json(data) + b'\n', status=code, mimetype='application/json')
+    response.headers.extend(headers or {})
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses large buffered responses with the best encoding of the request's Accept-Encoding.
+    """
+    if response.mimetype not in COMPRESSIBLE_TYPES or response.is_streamed or response.direct_passthrough \
+            or not 200 <= response.status_code < 300 or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if not encoding or response.content_length is None or response.content_length < COMPRESSION_MIN_SIZE:
+        return response
+
+    body = response.get_data()
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+
+    # The compressed bytes differ from the identity ones, so the ETag only stays valid as a weak one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def bump_versions(owner, *names):
+    """
+    Records a write to the named collections of an owner, which invalidates the cached responses that read them.
+    """
+    collection_versions.bump(owner, *names)
+
+
+def current_owner():
+    """
+    Returns the owner of the closet the request works on.
+    """
+    return request.headers.get(OWNER_HEADER) or DEFAULT_OWNER
+
+
+@app.before_request
+def check_owner():
+    if request.endpoint in OWNERLESS_ENDPOINTS:
+        return None
+    owner = request.headers.get(OWNER_HEADER)
+    if owner is None:
+        if REQUIRE_OWNER:
+            return {'message': f'Unauthorized: missing {OWNER_HEADER} header'}, 401
+    elif not owner.strip() or len(owner) > OWNER_MAX_LENGTH:
+        return {'message': f'Bad request: invalid {OWNER_HEADER} header'}, 400
+    return None
+
+
+# Shared keep-alive session for the external APIs
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+http_session.mount('http://', HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+
+# Keep-alive session for the image hosts, one connection pool per host
+image_session = requests.Session()
+image_session.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=HTTP_POOL_SIZE))
+image_session.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=HTTP_POOL_SIZE))
+
+# Runs database queries that can overlap with the external lookups
+lookup_executor = ThreadPoolExecutor(max_workers=8)
+
+# Validates the photo URLs of bulk ingests, shared by all requests so the number of threads stays bounded
+validation_executor = ThreadPoolExecutor(max_workers=BULK_VALIDATION_WORKERS)
+
+# Entries are (weather, fetched_at) and outlive the TTL by the stale window
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL + WEATHER_STALE_TTL)
+weather_flight = SingleFlight()
+
+
+def ensure_indexes():
+    """
+    Creates the indexes the queries rely on, the unique ones also guarantee that ids and photos are unique
+    in each closet. They all lead with owner, so every query of a closet only reads that closet's entries.
+    """
+    clothes_collection.create_index([('owner', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], unique=True)
+    if 'owner_1_photo_1' not in clothes_collection.index_information():
+        check_duplicate_photos()
+    clothes_collection.create_index([('owner', pymongo.ASCENDING), ('photo', pymongo.ASCENDING)], unique=True)
+    clothes_collection.create_index([('owner', pymongo.ASCENDING), ('type', pymongo.ASCENDING),
+                                     ('id', pymongo.ASCENDING)])
+    clothes_collection.create_index([('owner', pymongo.ASCENDING), ('color', pymongo.ASCENDING),
+                                     ('id', pymongo.ASCENDING)])
+    outfits_collection.create_index([('owner', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], unique=True)
+    outfits_collection.create_index([('owner', pymongo.ASCENDING), ('pieceIds', pymongo.ASCENDING)])
+    outfits_collection.create_index([('owner', pymongo.ASCENDING), ('suitableWeathers', pymongo.ASCENDING),
+                                     ('waterproof', pymongo.ASCENDING), ('style', pymongo.ASCENDING)])
+    outfits_collection.create_index([('owner', pymongo.ASCENDING), ('suitableWeathers', pymongo.ASCENDING),
+                                     ('waterproof', pymongo.ASCENDING), ('clothingItems.type', pymongo.ASCENDING)])
+    ratings_collection.create_index([('owner', pymongo.ASCENDING), ('id', pymongo.ASCENDING)], unique=True)
+    rating_scores_collection.create_index([('owner', pymongo.ASCENDING), ('id', pymongo.ASCENDING)])
+    ratings_collection.create_index([('owner', pymongo.ASCENDING), ('average', pymongo.DESCENDING),
+                                     ('count', pymongo.ASCENDING)])
+    photo_validations_collection.create_index([('owner', pymongo.ASCENDING), ('pieceId', pymongo.ASCENDING)],
+                                              unique=True)
+    photo_validations_collection.create_index('runAt')
+
+
+def check_duplicate_photos(limit=20):
+    """
+    Raises a RuntimeError listing the pieces sharing a photo in a closet, which the unique index on (owner, photo)
+    can't be built over. They were allowed before the index existed and have to be fixed by hand.
+    """
+    duplicates = list(clothes_collection.aggregate([
+        {'$group': {'_id': {'owner': '$owner', 'photo': '$photo'}, 'ids': {'$push': '$id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        {'$limit': limit}
+    ], allowDiskUse=True))
+    if duplicates:
+        lines = [f"owner {duplicate['_id']['owner']}, photo {duplicate['_id']['photo']}: pieces {duplicate['ids']}"
+                 for duplicate in duplicates]
+        raise RuntimeError('Pieces share a photo in the same closet, update or delete them before starting the app '
+                           f'(at most {limit} shown):\n' + '\n'.join(lines))
+
+
+def prepare_database():
+    """
+    Creates the indexes and runs the data migrations, once at startup before the workers serve requests.
+    """
+    run_migration('owners', backfill_owners)
+    drop_legacy_indexes()
+    ensure_indexes()
+    if MONGO_SHARDING:
+        shard_collections()
+    run_migration('rating-scores', migrate_rating_scores)
+    run_migration('outfit-piece-ids', backfill_outfit_piece_ids)
+
+
+def run_migration(name, migrate):
+    """
+    Runs a data migration unless its marker in the Versions collection records that it already completed,
+    so the collection scans of the migrations only happen on the first start after they were introduced.
+    """
+    marker = f'migration:{name}'
+    if versions_collection.find_one({'_id': marker}, {'_id': 1}):
+        return
+    migrate()
+    versions_collection.update_one({'_id': marker}, {'$set': {'completedAt': time.time()}}, upsert=True)
+
+
+def shutdown():
+    """
+    Releases the resources of a worker that stops: waits for the background lookups and photo validations,
+    and closes the MongoDB client.
+    """
+    photo_validation_queue.stop()
+    weather_prefetcher.stop()
+    lookup_executor.shutdown(wait=True)
+    validation_executor.shutdown(wait=True)
+    client.close()
+
+
+def backfill_owners():
+    """
+    Gives the documents stored before closets had owners to DEFAULT_OWNER.
+    """
+    for collection in (clothes_collection, outfits_collection, ratings_collection, rating_scores_collection,
+                       photo_validations_collection):
+        collection.update_many({'owner': {'$exists': False}}, {'$set': {'owner': DEFAULT_OWNER}})
+
+
+def drop_legacy_indexes():
+    """
+    Drops the indexes created before closets had owners, ensure_indexes replaces them with indexes leading
+    with owner (the unique ones would reject the same id or photo in two closets, and they prevent sharding).
+    """
+    legacy_indexes = [
+        (clothes_collection, ['id_1', 'photo_1']),
+        (outfits_collection, ['id_1', 'outfitPhoto_1', 'pieceIds_1', 'suitableWeathers_1_waterproof_1_style_1',
+                              'suitableWeathers_1_waterproof_1_clothingItems.type_1']),
+        (ratings_collection, ['id_1', 'average_-1_count_1']),
+        (rating_scores_collection, ['id_1']),
+        (photo_validations_collection, ['pieceId_1']),
+    ]
+    for collection, names in legacy_indexes:
+        existing = collection.index_information()
+        for name in names:
+            if name in existing:
+                collection.drop_index(name)
+
+
+def shard_collections():
+    """
+    Shards the collections on owner, every closet then lives on a single shard and its queries target it.
+    """
+    client.admin.command('enableSharding', db.name)
+    for collection in (clothes_collection, outfits_collection, ratings_collection, rating_scores_collection):
+        client.admin.command('shardCollection', collection.full_name, key={'owner': 1})
+
+
+def migrate_rating_scores():
+    """
+    Converts ratings that still store every score in a 'scores' array into running aggregates.
+    """
+    updates = []
+    for rating in ratings_collection.find({'scores': {'$exists': True}}, {'owner': 1, 'id': 1, 'scores': 1}):
+        scores = rating['scores']
+        histogram = {}
+        for score in scores:
+            histogram[str(int(score))] = histogram.get(str(int(score)), 0) + 1
+        aggregates = {
+            'count': len(scores),
+            'sum': sum(scores),
+            'sumSquares': sum(score * score for score in scores),
+            'histogram': histogram
+        }
+        if scores:
+            aggregates['average'] = aggregates['sum'] / aggregates['count']
+        updates.append(pymongo.UpdateOne({'_id': rating['_id']}, {'$set': aggregates, '$unset': {'scores': ''}}))
+        if LOG_RATING_SCORES and scores:
+            rating_scores_collection.insert_many([{'owner': rating.get('owner', DEFAULT_OWNER), 'id': rating['id'], 'score': score}
+                                                  for score in scores])
+    if updates:
+        ratings_collection.bulk_write(updates, ordered=False)
+
+
+def backfill_outfit_piece_ids(batch_size=1000):
+    """
+    Records the piece ids of outfits created before outfits stored them, matching their photos to the closet.
+    """
+    while True:
+        outfits = list(outfits_collection.find({'pieceIds': {'$exists': False}},
+                                               {'_id': 1, 'owner': 1, 'outfitPhoto': 1}).limit(batch_size))
+        if not outfits:
+            return
+        owners = list({outfit.get('owner', DEFAULT_OWNER) for outfit in outfits})
+        photos = list({photo for outfit in outfits for photo in outfit.get('outfitPhoto', [])})
+        piece_ids = {(piece['owner'], piece['photo']): piece['id'] for piece in clothes_collection.find(
+            {'owner': {'$in': owners}, 'photo': {'$in': photos}}, {'_id': 0, 'owner': 1, 'id': 1, 'photo': 1})}
+        outfits_collection.bulk_write([
+            pymongo.UpdateOne({'_id': outfit['_id']}, {'$set': {'pieceIds': [
+                piece_ids[(outfit.get('owner', DEFAULT_OWNER), photo)] for photo in outfit.get('outfitPhoto', [])
+                if (outfit.get('owner', DEFAULT_OWNER), photo) in piece_ids]}})
+            for outfit in outfits
+        ], ordered=False)
+
+
+def insert_with_unique_id(collection, document):
+    """
+    Inserts the document with a new uuid as its 'id' and returns it.
+    The unique index on (owner, id) rejects the (very unlikely) collisions, in which case a new uuid is drawn.
+    Other duplicate key errors are raised to the caller.
+    """
+    while True:
+        document['id'] = str(uuid.uuid4())
+        try:
+            collection.insert_one(document)
+            return document['id']
+        except pymongo.errors.DuplicateKeyError as e:
+            if 'id' not in (e.details or {}).get('keyPattern', {}):
+                raise
+
+
+# None until the first transaction tells whether the server supports them (replica set or mongos)
+transactions_supported = None
+
+
+def run_transaction(callback):
+    """
+    Runs callback(session) in a multi-document transaction and returns its result.
+    Standalone servers don't support transactions, there the callback runs without one (session is None).
+    """
+    global transactions_supported
+    if transactions_supported is not False:
+        try:
+            with client.start_session() as session:
+                result = session.with_transaction(callback)
+            transactions_supported = True
+            return result
+        except pymongo.errors.OperationFailure as e:
+            # IllegalOperation: transaction numbers are only allowed on a replica set member or mongos
+            if e.code != 20:
+                raise
+            transactions_supported = False
+    return callback(None)
+
+
+def delete_pieces(owner, piece_ids, session=None):
+    """
+    Deletes the pieces of the owner with the given ids, the outfits using them and the ratings of those outfits,
+    with one query per collection. Returns the deleted pieces and the ids of the deleted outfits.
+    """
+    pieces = list(clothes_collection.find({'owner': owner, 'id': {'$in': piece_ids}}, {'_id': 0, 'id': 1, 'photo': 1},
+                                          session=session))
+    found_ids = [piece['id'] for piece in pieces]
+    if not found_ids:
+        return [], []
+    clothes_collection.delete_many({'owner': owner, 'id': {'$in': found_ids}}, session=session)
+
+    # Find all outfits using the pieces, through the index on (owner, pieceIds)
+    outfits = outfits_collection.find({'owner': owner, 'pieceIds': {'$in': found_ids}}, {'_id': 0, 'id': 1},
+                                      session=session)
+    outfit_ids = [outfit['id'] for outfit in outfits]
+    if outfit_ids:
+        outfits_collection.delete_many({'owner': owner, 'id': {'$in': outfit_ids}}, session=session)
+        ratings_collection.delete_many({'owner': owner, 'id': {'$in': outfit_ids}}, session=session)
+        rating_scores_collection.delete_many({'owner': owner, 'id': {'$in': outfit_ids}}, session=session)
+    return pieces, outfit_ids
+
+
+def replace_piece_photo(owner, piece, photo, update, session=None):
+    """
+    Applies update to the piece and replaces its photo in the outfits using it and in their ratings,
+    with one query per collection. Returns the updated outfits.
+    """
+    clothes_collection.update_one({'owner': owner, 'id': piece['id']}, update, session=session)
+
+    # Find all outfits using the piece, through the index on (owner, pieceIds)
+    outfits = list(outfits_collection.find({'owner': owner, 'pieceIds': piece['id']}, {'_id': 0}, session=session))
+    if not outfits:
+        return []
+    outfit_ids = [outfit['id'] for outfit in outfits]
+    outfits_collection.update_many(
+        {'owner': owner, 'id': {'$in': outfit_ids}},
+        {'$set': {'clothingItems.$[item].photo': photo, 'outfitPhoto.$[photo]': photo}},
+        array_filters=[{'item.photo': piece['photo']}, {'photo': piece['photo']}], session=session)
+    ratings_collection.update_many(
+        {'owner': owner, 'id': {'$in': outfit_ids}},
+        {'$set': {'pictures.$[picture]': photo}},
+        array_filters=[{'picture': piece['photo']}], session=session)
+
+    for outfit in outfits:
+        for item in outfit['clothingItems']:
+            if item['photo'] == piece['photo']:
+                item['photo'] = photo
+        outfit['outfitPhoto'] = [photo if picture == piece['photo'] else picture for picture in outfit['outfitPhoto']]
+    return outfits
+
+
+def parse_page_args(args, query):
+    """
+    Reads the pagination parameters of the request and returns (query, limit, projection).
+    - limit: max number of documents to return
+    - after: the id of the last document of the previous page (keyset pagination on 'id')
+    - fields: comma separated list of the fields to return
+    """
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if not 1 <= limit <= PAGE_MAX_LIMIT:
+            raise ValueError(f'limit should be between 1 and {PAGE_MAX_LIMIT}')
+
+    after = args.get('after')
+    if after:
+        query = {'$and': [query, {'id': {'$gt': after}}]}
+
+    projection = dict(HIDDEN_FIELDS)
+    fields = args.get('fields')
+    if fields:
+        projection = {'_id': 0}
+        # The hidden fields can't be asked for, the owner only reads their own closet
+        projection.update({field: 1 for field in map(str.strip, fields.split(','))
+                           if field and field.split('.')[0] not in HIDDEN_FIELDS})
+        projection['id'] = 1  # the cursor of the next page
+
+    return query, limit, projection
+
+
+def find_page(collection, query, args):
+    """
+    Runs the query with the pagination parameters of the request and returns (cursor, limit).
+    """
+    query, limit, projection = parse_page_args(args, query)
+    cursor = collection.find(query, projection)
+    if limit or 'after' in args:
+        cursor = cursor.sort('id', pymongo.ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor, limit
+
+
+def aggregate_page(collection, query, args, stages):
+    """
+    Like find_page, but reshapes the matching documents with the given aggregation stages inside Mongo.
+    """
+    query, limit, projection = parse_page_args(args, query)
+    pipeline = [{'$match': query}]
+    if limit or 'after' in args:
+        pipeline.append({'$sort': {'id': pymongo.ASCENDING}})
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.extend(stages)
+    pipeline.append({'$project': projection})
+    return collection.aggregate(pipeline), limit
+
+
+def read_page(documents, limit, transform=None):
+    """
+    Reads a page of documents, optionally reshaping them with transform (documents it maps to None are dropped).
+    Returns the page and its headers, X-Next-After holds the cursor of the next page when the page is full.
+    """
+    page = []
+    count = 0
+    last_id = None
+    for document in documents:
+        count += 1
+        last_id = document.get('id')
+        if transform:
+            document = transform(document)
+            if document is None:
+                continue
+        page.append(document)
+
+    headers = {}
+    if limit and count == limit and last_id:
+        headers['X-Next-After'] = last_id
+    return page, headers
+
+
+def page_records(records, args):
+    """
+    Applies the pagination parameters of the request to in-memory documents, returns (page, limit) like find_page.
+    """
+    _, limit, projection = parse_page_args(args, {})
+    after = args.get('after')
+    if after:
+        records = [record for record in records if record['id'] > after]
+    if limit or 'after' in args:
+        records = sorted(records, key=lambda record: record['id'])
+    if limit:
+        records = records[:limit]
+
+    included = [field for field, value in projection.items() if value]
+    if included:
+        return [{field: record[field] for field in included if field in record} for record in records], limit
+    return [{field: value for field, value in record.items() if field not in projection} for record in records], limit
+
+
+def wants_ndjson():
+    return 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+def stream_ndjson(documents, transform=None):
+    """
+    Streams the documents straight from the cursor as newline delimited JSON, without building a list.
+    """
+    def generate():
+        for document in documents:
+            if transform:
+                document = transform(document)
+                if document is None:
+                    continue
+            yield dumps_json(document) + b'\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
 
 
 class Clothes(Resource):
+    @cached_response('Clothes')
     def get(self):
         args = request.args
         try:
-            if args:
-                query = {key: value for key, value in args.items()}
-                filtered_clothes = list(clothes_collection.find(query, {'_id': 0}))
-            else:
-                filtered_clothes = list(clothes_collection.find({}, {'_id': 0}))
-            return filtered_clothes, 200
+            query = {key: value for key, value in args.items() if key not in PAGE_PARAMS}
+            # Pieces whose photo isn't validated are only listed when asked for with ?validation=
+            if 'validation' not in query:
+                query.update(VALIDATED_PIECES)
+            # The filters only ever apply to the closet of the request's owner
+            query['owner'] = current_owner()
+            pieces, limit = find_page(clothes_collection, query, args)
+            if wants_ndjson():
+                return stream_ndjson(pieces)
+            filtered_clothes, headers = read_page(pieces, limit)
+            return filtered_clothes, 200, headers
+        except ValueError as e:
+            return {'message': f'Bad request: {e}'}, 400
         except Exception as e:
             return {'Error fetching data': str(e)}, 500
 
@@ -43,107 +1031,279 @@ class Clothes(Resource):
 
             data = request.json
 
-            # Check if there's a missing field
-            if not all(field in data for field in ['type', 'color', 'photo']):
-                return {'message': 'Unprocessable entity: Missing required fields'}, 422
-
-            if not data['type'].split() or not data['color'].split() \
-                    or not data['photo'].split():
-                return {'message': 'Unprocessable entity: Empty fields are not accepted'}, 422
+            # Check for missing or empty fields and for an invalid type
+            error = validate_piece(data)
+            if error:
+                return {'message': error}, 422
 
-            # Check for invalid image url
-            if not is_valid_url(data['photo']):
+            # Check for invalid image url, in async mode only its format is checked before answering
+            if not is_valid_url(data['photo'], check_remote=not ASYNC_PHOTO_VALIDATION):
                 return {'message': 'Unprocessable entity: invalid url'}, 422
-            
-            # Check for duplicate photo URL
-            if clothes_collection.find_one({'photo': data['photo']}):
-                return {'message': 'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.'}, 422
-
-            # Check for invalid type
-            accepted_types = ['Dress', 'Shirt', 'Long Pants', 'Short Pants', 'Skirt', 'Shoes', 'Jacket', 'Bag', 'Hat',
-                              'Belt', 'Scarf', 'SunGlasses']
-            if data['type'] not in accepted_types:
-                return {'message': 'Unprocessable entity: Invalid type value'}, 422
-
-            while True:
-                piece_id = str(uuid.uuid4())  # generate a unique id for each piece
-                if clothes_ids.find_one({'PieceID': piece_id}) is None:
-                    clothes_ids.insert_one({'PieceID': piece_id})
-                    break
 
+            owner = current_owner()
             piece = {
+                'owner': owner,
                 'type': data['type'],  # such as: dress, pants, shirt, etc
                 'color': data['color'],
                 'waterProof': data.get('waterProof', False),
-                'photo': data['photo'],
-                'id': piece_id
+                'photo': data['photo']
             }
-            clothes_collection.insert_one(piece)
+            if ASYNC_PHOTO_VALIDATION:
+                piece['validation'] = 'pending'
+
+            # The unique index on photo rejects duplicate photo URLs
+            try:
+                piece_id = insert_with_unique_id(clothes_collection, piece)
+            except pymongo.errors.DuplicateKeyError:
+                return {'message': 'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.'}, 422
+            bump_versions(owner, 'Clothes')
+
+            if ASYNC_PHOTO_VALIDATION:
+                photo_validation_queue.enqueue(owner, piece_id, piece['photo'])
+                return {'created': piece_id, 'validation': 'pending'}, 202, {'Location': f'/clothes/{piece_id}'}
             return {'created': piece_id}, 201
 
         except Exception as e:
             return {'Invalid JSON file': str(e)}, 422
 
+    def delete(self):
+        try:
+            # The ids come as a JSON body {"ids": [...]} or as a comma separated ids query parameter
+            if request.args.get('ids'):
+                piece_ids = request.args['ids'].split(',')
+            else:
+                data = request.get_json(silent=True)
+                piece_ids = data.get('ids') if isinstance(data, dict) else None
+
+            if not isinstance(piece_ids, list) or not piece_ids \
+                    or not all(isinstance(piece_id, str) for piece_id in piece_ids):
+                return {'message': 'Unprocessable entity: ids must be a non-empty list of piece ids'}, 422
+
+            if len(piece_ids) > BULK_MAX_ITEMS:
+                return {'message': f'Unprocessable entity: at most {BULK_MAX_ITEMS} pieces per request'}, 422
+
+            # Delete the pieces, the outfits using them and their ratings in one transaction
+            owner = current_owner()
+            pieces, outfit_ids = run_transaction(lambda session: delete_pieces(owner, piece_ids, session))
+            if pieces:
+                bump_versions(owner, 'Clothes', 'Outfits', 'Ratings')
+                update_outfit_index(owner, removed=outfit_ids)
+
+            deleted_ids = [piece['id'] for piece in pieces]
+            return {
+                'message': 'Clothing items, associated outfits, and related ratings successfully deleted',
+                'deleted': deleted_ids,
+                'notFound': sorted(set(piece_ids) - set(deleted_ids)),
+                'deletedOutfits': outfit_ids
+            }, 200
+
+        except Exception as e:
+            return {'error': str(e)}, 500
+
+class ClothesBulk(Resource):
+    def post(self):
+        try:
+            # Check if the mediaType is JSON
+            if request.headers['Content-Type'] != 'application/json':
+                return {'error': 'Unsupported Media Type: Only JSON is supported.'}, 415
+
+            data = request.json
+            items = data.get('items') if isinstance(data, dict) else data
+
+            if not isinstance(items, list) or not items:
+                return {'message': 'Unprocessable entity: items must be a non-empty list of pieces'}, 422
+
+            if len(items) > BULK_MAX_ITEMS:
+                return {'message': f'Unprocessable entity: at most {BULK_MAX_ITEMS} pieces per request'}, 422
+
+            # Trusted ingest can skip the remote image check, when the deployment allows it
+            check_remote = request.args.get('skipValidation', 'false').lower() != 'true'
+            if not check_remote and not BULK_ALLOW_SKIP_VALIDATION:
+                return {'message': 'Forbidden: skipValidation is disabled on this server'}, 403
+
+            # Validate the fields and dedupe the photos within the batch
+            errors = {}
+            first_index_of_photo = {}
+            for index, item in enumerate(items):
+                try:
+                    error = validate_piece(item)
+                except Exception as e:
+                    error = f'Unprocessable entity: {e}'
+                if not error and item['photo'] in first_index_of_photo:
+                    error = 'Unprocessable entity: Duplicate photo URL in batch'
+                if error:
+                    errors[index] = error
+                else:
+                    first_index_of_photo[item['photo']] = index
+
+            # Check for photos already in the closet with a single query
+            owner = current_owner()
+            existing = clothes_collection.find(
+                {'owner': owner, 'photo': {'$in': list(first_index_of_photo)}},
+                {'_id': 0, 'photo': 1}
+            )
+            for piece in existing:
+                index = first_index_of_photo.pop(piece['photo'])
+                errors[index] = 'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.'
+
+            # Validate the remaining photo URLs concurrently
+            photos = list(first_index_of_photo)
+            validations = validation_executor.map(lambda url: is_valid_url(url, check_remote), photos)
+            for photo, valid in zip(photos, validations):
+                if not valid:
+                    errors[first_index_of_photo.pop(photo)] = 'Unprocessable entity: invalid url'
+
+            pieces = {}
+            for index in sorted(first_index_of_photo.values()):
+                item = items[index]
+                pieces[index] = {
+                    'owner': owner,
+                    'type': item['type'],
+                    'color': item['color'],
+                    'waterProof': item.get('waterProof', False),
+                    'photo': item['photo'],
+                    'id': str(uuid.uuid4())
+                }
+
+            if pieces:
+                indexes = list(pieces)
+                try:
+                    clothes_collection.insert_many(list(pieces.values()), ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    for write_error in e.details['writeErrors']:
+                        index = indexes[write_error['index']]
+                        if write_error['code'] == 11000:
+                            # Added concurrently by another request
+                            errors[index] = 'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.'
+                        else:
+                            errors[index] = f"Unprocessable entity: {write_error['errmsg']}"
+                        del pieces[index]
+
+            if pieces:
+                bump_versions(owner, 'Clothes')
+
+            results = []
+            for index in range(len(items)):
+                if index in pieces:
+                    results.append({'index': index, 'created': pieces[index]['id']})
+                else:
+                    results.append({'index': index, 'error': errors[index]})
+
+            return {'created': len(pieces), 'failed': len(errors), 'results': results}, 201 if pieces else 422
+
+        except Exception as e:
+            return {'Invalid JSON file': str(e)}, 422
+
+def parse_search_filters(args):
+    """
+    Reads the facet filters of a search, returns {facet: query}. A facet accepts several values, as repeated
+    or comma separated parameters: ?type=Shirt,Dress&color=red&color=blue matches the red or blue shirts and dresses.
+    """
+    filters = {}
+    for facet in SEARCH_FACETS:
+        values = [value.strip() for arg in args.getlist(facet) for value in arg.split(',') if value.strip()]
+        if not values:
+            continue
+        if facet == 'waterProof':
+            if not all(value.lower() in ('true', 'false') for value in values):
+                raise ValueError('waterProof should be true or false')
+            values = [value.lower() == 'true' for value in values]
+        filters[facet] = {'$in': values}
+    return filters
+
+
+def count_facets(owner, filters):
+    """
+    Counts the owner's pieces per value of every facet with a single $facet aggregation. The counts of a facet
+    apply the filters of the other facets only, so they tell how many pieces each of its values would add.
+    """
+    facets = {'total': [{'$match': filters}, {'$count': 'count'}]}
+    for facet in SEARCH_FACETS:
+        other_filters = {other: query for other, query in filters.items() if other != facet}
+        facets[facet] = [{'$match': other_filters}, {'$group': {'_id': '$' + facet, 'count': {'$sum': 1}}},
+                         {'$sort': {'count': pymongo.DESCENDING, '_id': pymongo.ASCENDING}}]
+    result = next(clothes_collection.aggregate([{'$match': dict(VALIDATED_PIECES, owner=owner)},
+                                                {'$facet': facets}]))
+
+    counts = {}
+    for facet in SEARCH_FACETS:
+        # JSON keys are strings, so true/false/null are spelled as in JSON
+        counts[facet] = {(value['_id'] if isinstance(value['_id'], str) else json.dumps(value['_id'])):
+                         value['count'] for value in result[facet]}
+    return result['total'][0]['count'] if result['total'] else 0, counts
+
+
+class ClothesSearch(Resource):
+    @cached_response('Clothes')
+    def get(self):
+        args = request.args
+        owner = current_owner()
+        try:
+            filters = parse_search_filters(args)
+            _, limit, projection = parse_page_args(args, {})
+            sort = args.get('sort', 'id')
+            key = sort[1:] if sort.startswith('-') else sort
+            if key not in SEARCH_SORTS:
+                raise ValueError(f'sort should be one of {SEARCH_SORTS}, prefixed with - for descending order')
+        except ValueError as e:
+            return {'message': f'Bad request: {e}'}, 400
+
+        # The facets are counted by MongoDB while the page is read
+        facet_counts = lookup_executor.submit(count_facets, owner, filters)
+
+        # Keyset pagination on (sort, id): the page starts after the piece whose id is given
+        direction = pymongo.DESCENDING if sort.startswith('-') else pymongo.ASCENDING
+        query = dict(filters, owner=owner, **VALIDATED_PIECES)
+        after = args.get('after')
+        if after:
+            operator = '$lt' if direction == pymongo.DESCENDING else '$gt'
+            if key == 'id':
+                query['id'] = {operator: after}
+            else:
+                last = clothes_collection.find_one({'owner': owner, 'id': after}, {'_id': 0, key: 1})
+                if last is None:
+                    facet_counts.cancel()
+                    return {'message': 'Bad request: after should be the id of a piece'}, 400
+                query['$or'] = [{key: {operator: last.get(key)}}, {key: last.get(key), 'id': {operator: after}}]
+
+        order = [(key, direction), ('id', direction)] if key != 'id' else [('id', direction)]
+        cursor = clothes_collection.find(query, projection).sort(order)
+        if limit:
+            cursor = cursor.limit(limit)
+        pieces, headers = read_page(cursor, limit)
+
+        total, facets = facet_counts.result()
+        return {'results': pieces, 'total': total, 'facets': facets}, 200, headers
+
+
 class FilteredClothes(Resource):
+    @cached_response('Clothes')
     def get(self, id):
-        piece = clothes_collection.find_one({'id': id}, {'_id': 0})
+        piece = clothes_collection.find_one({'owner': current_owner(), 'id': id}, HIDDEN_FIELDS)
         if not piece:
             return {'message': 'Not Found: piece not found'}, 404
         return piece, 200
 
-    def get(self, type=None, color=None, waterProof=None):
-        # Build the query based on the parameters provided
-        query = {}
-        if type:
-            query['type'] = type
-        if color:
-            query['color'] = color
-        if waterProof:
-            query['waterProof'] = waterProof
-
-        # Perform the search with the constructed query
-        pieces = list(clothes_collection.find(query, {'_id': 0}))
-
-        if not pieces:
-            return {'message': 'Not Found: no pieces matching the criteria found'}, 404
-        else:
-            photos = [piece['photo'] for piece in pieces]
-            return photos, 200
-    
     def delete(self, id):
         try:
-            # Retrieve the photo URL of the clothing item using the given id
-            clothing_item = clothes_collection.find_one({'id': id}, {'photo': 1, '_id': 0})
-            if not clothing_item:
+            # Delete the clothing item, the outfits using it and their ratings in one transaction
+            owner = current_owner()
+            pieces, outfit_ids = run_transaction(lambda session: delete_pieces(owner, [id], session))
+            if not pieces:
                 return {'message': 'Not Found: clothing item not found'}, 404
-            
-            photo_url = clothing_item['photo']
-
-            # Delete the clothing item
-            clothes_collection.delete_one({'id': id})
-
-            # Find all outfits where the photo URL is in the outfitPhoto list
-            outfits_with_photo = list(outfits_collection.find({'outfitPhoto': photo_url}, {'id': 1, '_id': 0}))
-            
-            # Extract outfit IDs for deleting associated ratings
-            outfit_ids = [outfit['id'] for outfit in outfits_with_photo]
-
-            # Delete outfits containing the photo URL
-            outfits_collection.delete_many({'outfitPhoto': photo_url})
-
-            # Delete ratings associated with the deleted outfits
-            ratings_collection.delete_many({'id': {'$in': outfit_ids}})
+            bump_versions(owner, 'Clothes', 'Outfits', 'Ratings')
+            update_outfit_index(owner, removed=outfit_ids)
 
             return {
                 'message': 'Clothing item, associated outfits, and related ratings successfully deleted',
                 'id': id,
-                'deletedPhoto': photo_url
+                'deletedPhoto': pieces[0]['photo']
             }, 200
 
         except Exception as e:
             return {'error': str(e)}, 500
 
-    # Only to change photo urls
+    # Only to change photo urls, the outfits using the piece and their ratings get the new photo too
     def put(self, id):
         try:
             # Check if the mediaType is JSON
@@ -156,27 +1316,296 @@ class FilteredClothes(Resource):
             if 'photo' not in data:
                 return {'message': 'Unprocessable entity: Missing photo field'}, 422
 
-            # Validate the URL for the photo
-            if not is_valid_url(data['photo']):
+            # Validate the URL for the photo, in async mode only its format is checked before answering
+            if not is_valid_url(data['photo'], check_remote=not ASYNC_PHOTO_VALIDATION):
                 return {'message': 'Unprocessable entity: Invalid photo URL'}, 422
 
             # Find the existing piece by its ID
-            existing_piece = clothes_collection.find_one({'id': id})
+            owner = current_owner()
+            existing_piece = clothes_collection.find_one({'owner': owner, 'id': id})
             if not existing_piece:
                 return {'message': 'Not Found: Piece not found'}, 404
 
-            # Update the photo URL of the existing piece
-            clothes_collection.update_one(
-                {'id': id},
-                {'$set': {'photo': data['photo']}}  # Only update the photo field
-            )
+            # Update the photo URL of the existing piece, a validated photo clears the previous validation status
+            if ASYNC_PHOTO_VALIDATION:
+                update = {'$set': {'photo': data['photo'], 'validation': 'pending'}}
+            else:
+                update = {'$set': {'photo': data['photo']}, '$unset': {'validation': ''}}
+            try:
+                outfits = run_transaction(
+                    lambda session: replace_piece_photo(owner, existing_piece, data['photo'], update, session))
+            except pymongo.errors.DuplicateKeyError:
+                return {'message': 'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.'}, 422
+            if outfits:
+                bump_versions(owner, 'Clothes', 'Outfits', 'Ratings')
+                update_outfit_index(owner, upserted=outfits)
+            else:
+                bump_versions(owner, 'Clothes')
 
+            if ASYNC_PHOTO_VALIDATION:
+                photo_validation_queue.enqueue(owner, id, data['photo'])
+                return {'message': 'Piece photo update accepted, the photo is being validated', 'id': id,
+                        'validation': 'pending'}, 202
             return {'message': 'Piece photo updated successfully', 'id': id}, 200
 
         except Exception as e:
             return {'Invalid JSON file': str(e)}, 422
 
 
+# Replaces the clothing items of an outfit with the list of their types
+OUTFIT_TYPES_STAGES = [{'$set': {'clothingItems': '$clothingItems.type'}}]
+
+
+class OutfitIndex:
+    """
+    In-process index of each closet's outfits grouped by (weather, waterproof, style), so the weather-driven
+    lookups of GET /outfits are dictionary hits. The outfits are kept flattened, as GET /outfits returns them.
+    A closet is loaded on first use and reflects one version of its Outfits collection: the local writes
+    update it in place, a write of another worker changes the version and the closet is reloaded on next use.
+    Closets are evicted least recently used beyond max_outfits, closets larger than max_closet aren't indexed.
+    """
+    def __init__(self, max_outfits, max_closet):
+        self.max_outfits = max_outfits
+        self.max_closet = max_closet
+        self._closets = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def lookup(self, owner, weather, waterproof, style=None):
+        """
+        Returns the owner's outfits of the matching buckets, or None when the closet can't be indexed.
+        """
+        version = collection_versions.get(owner, ['Outfits'])[0]
+        with self._lock:
+            closet = self._closets.get(owner)
+            if closet is not None and closet['version'] == version:
+                self._closets.move_to_end(owner)
+                return self._collect(closet, weather, waterproof, style)
+
+        closet = self._flight.do(owner, self._load, owner, version)
+        with self._lock:
+            return self._collect(closet, weather, waterproof, style)
+
+    def upsert(self, owner, outfit):
+        """
+        Records a local write of an outfit document, after its 'Outfits' version bump.
+        """
+        record = {key: value for key, value in outfit.items() if key not in HIDDEN_FIELDS}
+        record['clothingItems'] = [item['type'] for item in record['clothingItems']]
+        with self._lock:
+            closet = self._closets.get(owner)
+            if closet is not None and closet['outfits'] is not None:
+                self._size -= len(closet['outfits'])
+                self._add(closet, record)
+                self._size += len(closet['outfits'])
+            if closet is not None:
+                closet['version'] += 1
+
+    def remove(self, owner, outfit_ids):
+        """
+        Records a local delete of outfits (possibly none), after its 'Outfits' version bump.
+        """
+        with self._lock:
+            closet = self._closets.get(owner)
+            if closet is not None and closet['outfits'] is not None:
+                self._size -= len(closet['outfits'])
+                for outfit_id in outfit_ids:
+                    self._discard(closet, outfit_id)
+                self._size += len(closet['outfits'])
+            if closet is not None:
+                closet['version'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'closets': len(self._closets), 'outfits': self._size}
+
+    def _load(self, owner, version):
+        outfits = list(outfits_collection.aggregate(
+            [{'$match': {'owner': owner}}, {'$limit': self.max_closet + 1}] + OUTFIT_TYPES_STAGES
+            + [{'$project': HIDDEN_FIELDS}]))
+
+        # Oversized closets are remembered too, so they aren't read again until they change
+        closet = {'version': version, 'outfits': None, 'buckets': {}}
+        if len(outfits) <= self.max_closet:
+            closet['outfits'] = {}
+            for outfit in outfits:
+                self._add(closet, outfit)
+
+        with self._lock:
+            previous = self._closets.pop(owner, None)
+            if previous is not None and previous['outfits'] is not None:
+                self._size -= len(previous['outfits'])
+            self._closets[owner] = closet
+            self._size += len(closet['outfits'] or ())
+            while self._size > self.max_outfits and len(self._closets) > 1:
+                _, evicted = self._closets.popitem(last=False)
+                self._size -= len(evicted['outfits'] or ())
+        return closet
+
+    @staticmethod
+    def _bucket(outfit):
+        return outfit.get('suitableWeathers'), outfit.get('waterproof'), outfit.get('style')
+
+    def _add(self, closet, outfit):
+        self._discard(closet, outfit['id'])
+        closet['outfits'][outfit['id']] = outfit
+        closet['buckets'].setdefault(self._bucket(outfit), {})[outfit['id']] = outfit
+
+    def _discard(self, closet, outfit_id):
+        outfit = closet['outfits'].pop(outfit_id, None)
+        if outfit is None:
+            return
+        closet['buckets'].get(self._bucket(outfit), {}).pop(outfit_id, None)
+
+    @staticmethod
+    def _collect(closet, weather, waterproof, style):
+        if closet['outfits'] is None:
+            return None
+        styles = [style] if style else ACCEPTED_STYLES
+        return [outfit for style in styles
+                for outfit in closet['buckets'].get((weather, waterproof, style), {}).values()]
+
+
+outfit_index = OutfitIndex(OUTFIT_INDEX_MAX_OUTFITS, OUTFIT_INDEX_MAX_CLOSET)
+
+
+def update_outfit_index(owner, upserted=(), removed=()):
+    """
+    Applies a local write to the outfit index, call it once per 'Outfits' version bump.
+    """
+    if not OUTFIT_INDEX:
+        return
+    if upserted:
+        for outfit in upserted:
+            outfit_index.upsert(owner, outfit)
+    else:
+        outfit_index.remove(owner, removed)
+
+
+class OutfitRules:
+    """
+    The clothing type rules of an outfit. They are compiled once into a table mapping each type
+    to the counters it increments, so an outfit is checked in a single pass over its items.
+    """
+    TOPS = ['Shirt', 'Dress']
+    BOTTOMS = ['Long Pants', 'Short Pants', 'Skirt', 'Dress']
+
+    def __init__(self, types):
+        self.types = list(types)
+        # One counter per type, followed by the top and bottom counters
+        self.top = len(self.types)
+        self.bottom = self.top + 1
+        self.shoes = self.types.index('Shoes')
+        self.increments = {}
+        for index, item_type in enumerate(self.types):
+            counters = [index]
+            if item_type in self.TOPS:
+                counters.append(self.top)
+            if item_type in self.BOTTOMS:
+                counters.append(self.bottom)
+            self.increments[item_type] = counters
+
+    def check(self, item_types):
+        """
+        Returns the first broken rule as an error message, or None if the types make a valid outfit.
+        """
+        counts = [0] * (len(self.types) + 2)
+        for item_type in item_types:
+            for counter in self.increments.get(item_type, ()):
+                counts[counter] += 1
+
+        if counts[self.shoes] < 1:
+            return 'You should have a pair of shoes!'
+        # A Dress counts both as a top and as a bottom
+        if counts[self.top] < 1:
+            return 'You should have at least one top!'
+        if counts[self.bottom] < 1:
+            return 'You should have at least one bottom!'
+        if counts[self.bottom] > 1:
+            return 'Too many bottoms!'
+        if counts[self.top] > 1:
+            return 'Too many tops!'
+        for index, item_type in enumerate(self.types):
+            if counts[index] > 1:
+                return f'Too many {item_type}s!'
+        return None
+
+
+outfit_rules = OutfitRules(ACCEPTED_TYPES)
+
+
+def load_pieces(owner, piece_ids):
+    """
+    Retrieves the clothing pieces of the owner with the given ids in a single query, returns a dict from id to piece.
+    Pieces whose photo isn't validated are left out, so they can't be used in outfits.
+    """
+    if not isinstance(piece_ids, list):
+        return {}
+    pieces = clothes_collection.find(
+        {'owner': owner, 'id': {'$in': [piece_id for piece_id in piece_ids if isinstance(piece_id, str)]},
+         **VALIDATED_PIECES},
+        {'_id': 0, 'id': 1, 'type': 1, 'photo': 1, 'waterProof': 1}
+    )
+    return {piece['id']: piece for piece in pieces}
+
+
+def validate_outfit(data, pieces, required_fields=('style', 'clothingItems', 'suitableWeathers')):
+    """
+    Validates an outfit request, pieces maps the ids of the clothing items to the stored pieces.
+    Returns an error message or None if the outfit is valid.
+    """
+    # Check if there's a missing field
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
+        return 'Unprocessable entity: Missing required fields'
+
+    clothing_item_ids = data['clothingItems']
+
+    # Validate that clothingItems is not empty
+    if not clothing_item_ids:
+        return 'Unprocessable entity: clothingItems must contain at least one ID'
+
+    # Check that all provided IDs exist in the database
+    if not isinstance(clothing_item_ids, list) \
+            or not all(isinstance(piece_id, str) and piece_id in pieces for piece_id in clothing_item_ids) \
+            or len(set(clothing_item_ids)) != len(clothing_item_ids):
+        return 'Unprocessable entity: One or more clothing item IDs are invalid'
+
+    # Validate clothing items based on their types
+    error = outfit_rules.check(pieces[piece_id]['type'] for piece_id in clothing_item_ids)
+    if error:
+        return error
+
+    # Check for invalid style
+    if 'style' in data and data['style'] not in ACCEPTED_STYLES:
+        return 'Unprocessable entity: Invalid style value'
+
+    # Check for invalid suitableWeathers
+    if 'suitableWeathers' in data and data['suitableWeathers'] not in ACCEPTED_WEATHERS:
+        return 'Unprocessable entity: Invalid weather value'
+
+    return None
+
+
+def build_outfit(data, pieces):
+    """
+    Prepares the outfit document of a validated outfit request.
+    """
+    clothing_items = [pieces[piece_id] for piece_id in data['clothingItems']]
+
+    # Determine whether the outfit should be marked as waterproof
+    waterproof = any(item['type'] == 'Jacket' and item.get('waterProof', False) for item in clothing_items)
+
+    return {
+        'style': data['style'],
+        'waterproof': waterproof,
+        'clothingItems': [{'type': item['type'], 'photo': item['photo']} for item in clothing_items],
+        'pieceIds': [item['id'] for item in clothing_items],
+        'suitableWeathers': data['suitableWeathers'],
+        'outfitPhoto': [item['photo'] for item in clothing_items]
+    }
+
+
 class Outfits(Resource):
     def get(self):
         args = request.args
@@ -189,8 +1618,16 @@ class Outfits(Resource):
             style = args.get('style')
             outfit_id = args.get('id')
 
+            # A lookup by id doesn't depend on the weather, so run it while the weather is fetched
+            owner = current_owner()
+            prefetched_outfits = None
+            if outfit_id:
+                prefetched_outfits = lookup_executor.submit(lambda: list(outfits_collection.aggregate(
+                    [{'$match': {'owner': owner, 'id': outfit_id}}] + OUTFIT_TYPES_STAGES
+                    + [{'$project': HIDDEN_FIELDS}])))
+
             # Automatically get the user's location based on their IP address
-            lat_lon = get_location_from_ip(self)
+            lat_lon = get_location_from_ip(self, get_client_ip())
             if not lat_lon:
                 return {'message': 'Could not determine location from IP address'}, 500
 
@@ -210,29 +1647,38 @@ class Outfits(Resource):
             if outfit_id:
                 query['id'] = outfit_id
 
-            # Perform the query to find matching outfits
-            filtered_outfits = list(outfits_collection.find(query, {'_id': 0}))
+            # Perform the query to find matching outfits, only the types of the clothing items are returned
+            if prefetched_outfits is not None:
+                outfits = [outfit for outfit in prefetched_outfits.result()
+                           if all(outfit.get(key) == value for key, value in query.items())
+                           and (not clothing_type or clothing_type in outfit['clothingItems'])]
+                limit = None
+            else:
+                # The in-process index answers without a query when the closet is indexed
+                indexed = outfit_index.lookup(owner, current_weather, should_be_waterproof, style) \
+                    if OUTFIT_INDEX else None
+                if indexed is not None:
+                    outfits, limit = page_records([outfit for outfit in indexed if not clothing_type
+                                                   or clothing_type in outfit['clothingItems']], args)
+                else:
+                    if clothing_type:
+                        query['clothingItems.type'] = clothing_type
+                    outfits, limit = aggregate_page(outfits_collection, dict(query, owner=owner), args,
+                                                    OUTFIT_TYPES_STAGES)
+
+            if wants_ndjson():
+                return stream_ndjson(outfits)
+
+            filtered_outfits, headers = read_page(outfits, limit)
 
             print_waterproof = "need" if should_be_waterproof else "don't need"
             if not filtered_outfits:
                 return {'message': f'The weather is {current_weather}, and we {print_waterproof} waterproof clothes, No outfits found matching this criteria'}, 404
-            
-            items = []
-            for outfit in filtered_outfits:
-                outfit['clothingItems'] = [{'type': item['type']} for item in outfit['clothingItems']]
-                items.extend(item['type'] for item in outfit['clothingItems'])
-                outfit['clothingItems'] = items
-                items = []
-
-            if clothing_type:
-                out = []
-                for outfit in filtered_outfits:
-                    if clothing_type in outfit['clothingItems']:
-                        out.append(outfit)
-
-                filtered_outfits = out
-            return filtered_outfits, 200
 
+            return filtered_outfits, 200, headers
+
+        except ValueError as e:
+            return {'message': f'Bad request: {e}'}, 400
         except Exception as e:
             return {'Error fetching data': str(e)}, 500
 
@@ -248,132 +1694,267 @@ class Outfits(Resource):
             if not all(field in data for field in ['style', 'clothingItems', 'suitableWeathers']):
                 return {'message': 'Unprocessable entity: Missing required fields'}, 422
 
-            clothing_item_ids = data['clothingItems']
-
-            # Validate that clothingItems is not empty
-            if not clothing_item_ids:
-                return {'message': 'Unprocessable entity: clothingItems must contain at least one ID'}, 422
-
-            # Retrieve clothing items from the database
-            clothing_items = list(clothes_collection.find(
-                {'id': {'$in': clothing_item_ids}},
-                {'_id': 0, 'type': 1, 'photo': 1}
-            ))
-
-            # Check that all provided IDs exist in the database
-            if len(clothing_items) != len(clothing_item_ids):
-                return {'message': 'Unprocessable entity: One or more clothing item IDs are invalid'}, 422
-
-            # Validate clothing items based on their types
-            item_types = ['Bag', 'Hat', 'Belt', 'Scarf', 'Sunglasses', 'Shoes', 'Jacket', 'Dress', 'Shirt',
-                        'Long Pants', 'Short Pants', 'Skirt']
-            item_counts = {item: 0 for item in item_types}
-
-            for item in clothing_items:
-                item_type = item['type']
-                if item_type in item_types:
-                    item_counts[item_type] += 1
-
-            # Check for item count validations
-            if item_counts['Shoes'] < 1:
-                return {'message': 'You should have a pair of shoes!'}, 422
-
-            # Check for at least one top (either Shirt or Dress)
-            if item_counts['Shirt'] < 1 and item_counts['Dress'] < 1:
-                return {'message': 'You should have at least one top!'}, 422
-
-            # Check for at least one bottom if no Dress is present
-            if item_counts['Dress'] < 1 and (
-                    item_counts['Long Pants'] + item_counts['Short Pants'] + item_counts['Skirt']) < 1:
-                return {'message': 'You should have at least one bottom!'}, 422
-            
-            #
-            if item_counts['Long Pants'] + item_counts['Short Pants'] + item_counts['Skirt'] + item_counts['Dress'] > 1:
-                return {'message':'Too many bottoms!'}, 422
-                
-            if item_counts['Shirt'] + item_counts['Dress'] > 1:
-                return {'message':'Too many tops!'}, 422
-            
-            # Check that no item type exceeds the limit of one (except accessories like Bag, Hat, etc., if allowed)
-            for item, count in item_counts.items():
-                if count > 1:
-                    return {'message': f'Too many {item}s!'}, 422
-                
-
-            # Check for invalid style
-            accepted_styles = ['Casual', 'Elegant', 'Sporty', 'Party', 'Work']
-            if data['style'] not in accepted_styles:
-                return {'message': 'Unprocessable entity: Invalid style value'}, 422
-
-            # Check for invalid suitableWeathers
-            accepted_weathers = ['Cold', 'Mild', 'Hot']
-            if data['suitableWeathers'] not in accepted_weathers:
-                return {'message': 'Unprocessable entity: Invalid weather value'}, 422
-
-            # Generate a unique ID for the outfit
-            while True:
-                outfit_id = str(uuid.uuid4())
-                if outfits_collection.find_one({'id': outfit_id}) is None:
-                    break
-
-            # Determine whether the outfit should be marked as waterproof
-            waterproof = any(item['type'] == 'Jacket' and item.get('waterProof', False) for item in clothing_items)
+            # Retrieve the clothing items from the database and check the outfit rules
+            owner = current_owner()
+            pieces = load_pieces(owner, data['clothingItems'])
+            error = validate_outfit(data, pieces)
+            if error:
+                return {'message': error}, 422
 
             # Prepare the outfit document
-            pictures = [item['photo'] for item in clothing_items]
-            outfit = {
-                'style': data['style'],
-                'waterproof': waterproof,
-                'clothingItems': clothing_items,
-                'suitableWeathers': data['suitableWeathers'],
-                'outfitPhoto': pictures,
-                'id': outfit_id
-            }
+            outfit = dict(build_outfit(data, pieces), owner=owner)
 
-            # Insert the outfit into the database
-            outfits_collection.insert_one(outfit)
+            # Insert the outfit into the database with a unique ID
+            outfit_id = insert_with_unique_id(outfits_collection, outfit)
 
             # Create a rating space for the outfit
-            ratings_collection.insert_one({'id': outfit_id, 'pictures': pictures})
+            ratings_collection.insert_one({'owner': owner, 'id': outfit_id, 'pictures': outfit['outfitPhoto']})
+            bump_versions(owner, 'Outfits', 'Ratings')
+            update_outfit_index(owner, upserted=[outfit])
             return {'Outfit added successfully to your closet!': outfit_id}, 201
 
         except Exception as e:
             return {'Invalid JSON file': str(e)}, 422
 
+class OutfitsValidate(Resource):
+    def post(self):
+        try:
+            # Check if the mediaType is JSON
+            if request.headers['Content-Type'] != 'application/json':
+                return {'error': 'Unsupported Media Type: Only JSON is supported.'}, 415
+
+            data = request.json
+            outfits = data.get('outfits') if isinstance(data, dict) else data
+
+            if not isinstance(outfits, list) or not outfits:
+                return {'message': 'Unprocessable entity: outfits must be a non-empty list of outfits'}, 422
+
+            if len(outfits) > VALIDATE_MAX_OUTFITS:
+                return {'message': f'Unprocessable entity: at most {VALIDATE_MAX_OUTFITS} outfits per request'}, 422
+
+            # Retrieve the pieces of all the outfits with a single query
+            piece_ids = set()
+            for outfit in outfits:
+                if isinstance(outfit, dict) and isinstance(outfit.get('clothingItems'), list):
+                    piece_ids.update(piece_id for piece_id in outfit['clothingItems'] if isinstance(piece_id, str))
+            pieces = load_pieces(current_owner(), list(piece_ids))
+
+            # Only the clothing items are required, style and suitableWeathers are checked when given
+            results = []
+            for index, outfit in enumerate(outfits):
+                error = validate_outfit(outfit, pieces, required_fields=('clothingItems',))
+                if error:
+                    results.append({'index': index, 'valid': False, 'error': error})
+                else:
+                    results.append({'index': index, 'valid': True})
+
+            return {'valid': sum(result['valid'] for result in results), 'results': results}, 200
+
+        except Exception as e:
+            return {'Invalid JSON file': str(e)}, 422
+
+piece_scores_cache = TTLCache(PIECE_SCORES_CACHE_SIZE, PIECE_SCORES_TTL)
+
+
+def load_piece_scores(owner):
+    """
+    Scores each piece of the owner by the average rating of the rated outfits it's part of, centered on 5 so that
+    well rated pieces score above zero. Returns a dict from piece id to score.
+    """
+    piece_scores = piece_scores_cache.get(owner)
+    if piece_scores is None:
+        # Two queries on the (owner, id) indexes, a $lookup on id alone would read the outfits of every owner
+        averages = {rating['id']: rating['average'] for rating in ratings_collection.find(
+            {'owner': owner, 'count': {'$gt': 0}}, {'_id': 0, 'id': 1, 'average': 1})}
+        outfits = outfits_collection.find({'owner': owner, 'id': {'$in': list(averages)}},
+                                          {'_id': 0, 'id': 1, 'pieceIds': 1})
+        totals = {}
+        for outfit in outfits:
+            for piece_id in outfit.get('pieceIds', []):
+                total = totals.setdefault(piece_id, [0, 0])
+                total[0] += averages[outfit['id']]
+                total[1] += 1
+        piece_scores = {piece_id: total / count - 5 for piece_id, (total, count) in totals.items()}
+        piece_scores_cache.set(owner, piece_scores)
+    return piece_scores
+
+
+class OutfitGenerator:
+    """
+    Enumerates the valid outfits of a closet from the best to the worst ranked.
+
+    The pieces are indexed per slot (top, bottom, shoes, jacket and one slot per accessory type),
+    each slot sorted by score. An outfit is one choice per slot of a template (shirt and bottom, or dress),
+    so the rules are enforced by construction: required slots can't be left empty and a rainy weather
+    only keeps the waterproof jackets. Outfits are then popped from a heap of index vectors, which only
+    explores the neighbours of the outfits already returned instead of the whole cross product.
+    """
+    ACCESSORIES = ['Bag', 'Hat', 'Belt', 'Scarf', 'SunGlasses']
+    BOTTOMS = ['Long Pants', 'Short Pants', 'Skirt']
+    OPTIONAL_PIECE_COST = 0.1  # unrated extras don't make an outfit better, so fewer pieces rank first
+
+    def __init__(self, pieces, piece_scores, weather, waterproof, pinned=None):
+        preferences = WEATHER_PREFERENCES.get(weather, {})
+
+        def score(piece):
+            return piece_scores.get(piece['id'], 0) + preferences.get(piece['type'], 0)
+
+        # Per slot candidate index, a pinned piece is the only candidate of its slot
+        pinned_slot = self.slot_of(pinned) if pinned else None
+        candidates = {}
+        for piece in [pinned] if pinned else []:
+            candidates[pinned_slot] = [(score(piece), piece)]
+        for piece in pieces:
+            slot = self.slot_of(piece)
+            if slot != pinned_slot:
+                candidates.setdefault(slot, []).append((score(piece), piece))
+
+        # In the rain only waterproof jackets are kept, and a jacket is required
+        if waterproof:
+            candidates['Jacket'] = [(piece_score, piece) for piece_score, piece in candidates.get('Jacket', [])
+                                    if piece.get('waterProof', False)]
+
+        def options(slot, required):
+            slot_candidates = candidates.get(slot, [])
+            # Optional slots can stay empty, which ranks before the pieces that don't improve the outfit
+            if not required and slot != pinned_slot:
+                slot_candidates = [(piece_score - self.OPTIONAL_PIECE_COST, piece)
+                                   for piece_score, piece in slot_candidates] + [(0, None)]
+            return sorted(slot_candidates, key=lambda option: (-option[0], option[1] is not None))
+
+        self.templates = []
+        for required_slots in (['Shirt', 'Bottom', 'Shoes'], ['Dress', 'Shoes']):
+            if waterproof:
+                required_slots = required_slots + ['Jacket']
+            optional_slots = [slot for slot in ['Jacket'] + self.ACCESSORIES if slot not in required_slots]
+            # A pinned piece must be part of the template
+            if pinned_slot and pinned_slot not in required_slots + optional_slots:
+                continue
+            template = [options(slot, True) for slot in required_slots]
+            template += [options(slot, False) for slot in optional_slots]
+            # Prune the templates with a required slot that has no candidates
+            if all(template):
+                self.templates.append(template)
+
+    def generate(self, limit, deadline):
+        heap = []
+        seen = set()
+        for template_index, template in enumerate(self.templates):
+            start = (0,) * len(template)
+            heapq.heappush(heap, (-self.score(template, start), template_index, start))
+            seen.add((template_index, start))
+
+        found = 0
+        while heap and found < limit and time.monotonic() < deadline:
+            negative_score, template_index, indexes = heapq.heappop(heap)
+            template = self.templates[template_index]
+            pieces = [template[slot][index][1] for slot, index in enumerate(indexes)]
+            pieces = [piece for piece in pieces if piece is not None]
+            if outfit_rules.check(piece['type'] for piece in pieces) is None:
+                found += 1
+                yield -negative_score, pieces
+
+            # The next best outfits differ from this one in a single slot
+            for slot in range(len(indexes)):
+                if indexes[slot] + 1 < len(template[slot]):
+                    neighbour = indexes[:slot] + (indexes[slot] + 1,) + indexes[slot + 1:]
+                    if (template_index, neighbour) not in seen:
+                        seen.add((template_index, neighbour))
+                        heapq.heappush(heap, (-self.score(template, neighbour), template_index, neighbour))
+
+    @staticmethod
+    def score(template, indexes):
+        return sum(template[slot][index][0] for slot, index in enumerate(indexes))
+
+    @classmethod
+    def slot_of(cls, piece):
+        return 'Bottom' if piece['type'] in cls.BOTTOMS else piece['type']
+
+
+class OutfitsGenerate(Resource):
+    def get(self):
+        args = request.args
+        try:
+            style = args.get('style')
+            if style not in ACCEPTED_STYLES:
+                return {'message': 'Unprocessable entity: Invalid style value'}, 422
+
+            limit = int(args.get('limit', GENERATE_DEFAULT_LIMIT))
+            budget = float(args.get('budgetMs', GENERATE_TIME_BUDGET * 1000)) / 1000
+            if not 1 <= limit <= GENERATE_MAX_LIMIT or not 0 < budget <= GENERATE_MAX_TIME_BUDGET:
+                return {'message': f'Bad request: limit should be between 1 and {GENERATE_MAX_LIMIT} '
+                                   f'and budgetMs at most {GENERATE_MAX_TIME_BUDGET * 1000}'}, 400
+
+            owner = current_owner()
+            pinned = None
+            if args.get('pinned'):
+                pinned = clothes_collection.find_one({'owner': owner, 'id': args['pinned'], **VALIDATED_PIECES},
+                                                     HIDDEN_FIELDS)
+                if not pinned:
+                    return {'message': 'Not Found: pinned piece not found'}, 404
+
+            # Automatically get the user's location and its current weather
+            lat_lon = get_location_from_ip(self, get_client_ip())
+            if not lat_lon:
+                return {'message': 'Could not determine location from IP address'}, 500
+            should_be_waterproof, current_weather = fetch_weather(self, *lat_lon)
+            if should_be_waterproof is None or current_weather is None:
+                return {'message': 'Could not fetch data'}, 500
+
+            pieces = clothes_collection.find({'owner': owner, **VALIDATED_PIECES},
+                                             {'_id': 0, 'id': 1, 'type': 1, 'photo': 1, 'waterProof': 1})
+            generator = OutfitGenerator(pieces, load_piece_scores(owner), current_weather, should_be_waterproof, pinned)
+            deadline = time.monotonic() + budget
+
+            # Stream each outfit as soon as it's found
+            def generate():
+                for score, outfit_pieces in generator.generate(limit, deadline):
+                    yield dumps_json({
+                        'style': style,
+                        'suitableWeathers': current_weather,
+                        'waterproof': any(piece['type'] == 'Jacket' and piece.get('waterProof', False)
+                                          for piece in outfit_pieces),
+                        'clothingItems': [piece['id'] for piece in outfit_pieces],
+                        'types': [piece['type'] for piece in outfit_pieces],
+                        'outfitPhoto': [piece['photo'] for piece in outfit_pieces],
+                        'score': round(score, 3)
+                    }) + b'\n'
+
+            return Response(generate(), mimetype='application/x-ndjson')
+
+        except ValueError:
+            return {'message': 'Bad request: limit and budgetMs should be numbers'}, 400
+        except Exception as e:
+            return {'Error generating outfits': str(e)}, 500
+
 class FilteredOutfit(Resource):
+    @cached_response('Outfits')
     def get(self, id):
         # Find the outfit by its ID
-        outfit = outfits_collection.find_one({'id': id}, {'_id': 0})
+        outfit = outfits_collection.find_one({'owner': current_owner(), 'id': id}, HIDDEN_FIELDS)
         if not outfit:
             return {'message': 'Not Found: outfi not found'}, 404
         return outfit, 200
 
-    def get(self, style=None, piece_id=None):
-        # Build the query based on the path parameters provided
-        query = {}
-        if style:
-            query['style'] = style
-        if piece_id:
-            # Find all outfits where 'clothing_items' contains 'piece_id'
-            query['clothing_items'] = piece_id
-
-        # Perform the query to find matching outfits
-        outfits = list(outfits_collection.find(query, {'_id': 0}))
-
-        if not outfits:
-            return {'message': 'Not Found: no outfits matching the criteria found'}, 404
-
-        # Return the list of matching outfits
-        return outfits, 200
-    
     def delete(self, id):
-        # find the outfit by its ID
-        delete_result = outfits_collection.delete_one({'id': id})
-        # Check if the outfit was found
-        if delete_result.deleted_count == 0:
+        owner = current_owner()
+
+        def delete_outfit(session):
+            # find the outfit by its ID
+            delete_result = outfits_collection.delete_one({'owner': owner, 'id': id}, session=session)
+            # Check if the outfit was found
+            if delete_result.deleted_count == 0:
+                return None
+            # Delete the associated rating
+            rating_scores_collection.delete_many({'owner': owner, 'id': id}, session=session)
+            return ratings_collection.delete_one({'owner': owner, 'id': id}, session=session)
+
+        # The outfit and its rating are deleted in one transaction
+        delete_rating_result = run_transaction(delete_outfit)
+        if delete_rating_result is None:
             return {'message': 'Outfit not found'}, 404
-        # Delete the associated rating
-        delete_rating_result = ratings_collection.delete_one({'id': id})
+        bump_versions(owner, 'Outfits', 'Ratings')
+        update_outfit_index(owner, removed=[id])
         if delete_rating_result.deleted_count == 0:
             return {'message': 'Rating not found'}, 404
         # Return a success message
@@ -382,7 +1963,8 @@ class FilteredOutfit(Resource):
     def put(self, id):
         try:
             # Check if the outfit exists
-            existing_outfit = outfits_collection.find_one({'id': id})
+            owner = current_owner()
+            existing_outfit = outfits_collection.find_one({'owner': owner, 'id': id})
             if not existing_outfit:
                 return {'message': 'Not Found: Outfit not found'}, 404
 
@@ -396,96 +1978,69 @@ class FilteredOutfit(Resource):
             if not all(field in data for field in ['style', 'clothingItems', 'suitableWeathers']):
                 return {'message': 'Unprocessable entity: Missing required fields'}, 422
 
-            clothing_item_ids = data['clothingItems']
-
-            # Validate that clothingItems is not empty
-            if not clothing_item_ids:
-                return {'message': 'Unprocessable entity: clothingItems must contain at least one ID'}, 422
-
-            # Retrieve clothing items from the database
-            clothing_items = list(clothes_collection.find(
-                {'id': {'$in': clothing_item_ids}},
-                {'_id': 0, 'type': 1, 'photo': 1}
-            ))
-
-            # Check that all provided IDs exist in the database
-            if len(clothing_items) != len(clothing_item_ids):
-                return {'message': 'Unprocessable entity: One or more clothing item IDs are invalid'}, 422
-
-            # Validate clothing items based on their types
-            item_types = ['Bag', 'Hat', 'Belt', 'Scarf', 'Sunglasses', 'Shoes', 'Jacket', 'Dress', 'Shirt',
-                        'Long Pants', 'Short Pants', 'Skirt']
-            item_counts = {item: 0 for item in item_types}
-
-            for item in clothing_items:
-                item_type = item['type']
-                if item_type in item_types:
-                    item_counts[item_type] += 1
-
-            # Check for item count validations
-            if item_counts['Shoes'] < 1:
-                return {'message': 'You should have a pair of shoes!'}, 422
-
-            # Check for at least one top (either Shirt or Dress)
-            if item_counts['Shirt'] < 1 and item_counts['Dress'] < 1:
-                return {'message': 'You should have at least one top!'}, 422
-
-            # Check for at least one bottom if no Dress is present
-            if item_counts['Dress'] < 1 and (
-                    item_counts['Long Pants'] + item_counts['Short Pants'] + item_counts['Skirt']) < 1:
-                return {'message': 'You should have at least one bottom!'}, 422
-
-            if item_counts['Long Pants'] + item_counts['Short Pants'] + item_counts['Skirt'] + item_counts['Dress'] > 1:
-                return {'message': 'Too many bottoms!'}, 422
-
-            if item_counts['Shirt'] + item_counts['Dress'] > 1:
-                return {'message': 'Too many tops!'}, 422
-
-            # Check for invalid style
-            accepted_styles = ['Casual', 'Elegant', 'Sporty', 'Party', 'Work']
-            if data['style'] not in accepted_styles:
-                return {'message': 'Unprocessable entity: Invalid style value'}, 422
-
-            # Check for invalid suitableWeathers
-            accepted_weathers = ['Cold', 'Mild', 'Hot']
-            if data['suitableWeathers'] not in accepted_weathers:
-                return {'message': 'Unprocessable entity: Invalid weather value'}, 422
-
-            # Determine whether the outfit should be marked as waterproof
-            waterproof = any(item['type'] == 'Jacket' and item.get('waterProof', False) for item in clothing_items)
+            # Retrieve the clothing items from the database and check the outfit rules
+            pieces = load_pieces(owner, data['clothingItems'])
+            error = validate_outfit(data, pieces)
+            if error:
+                return {'message': error}, 422
 
             # Prepare the outfit document for update
-            pictures = [item['photo'] for item in clothing_items]
-            updated_outfit = {
-                'style': data['style'],
-                'waterproof': waterproof,
-                'clothingItems': clothing_items,
-                'suitableWeathers': data['suitableWeathers'],
-                'outfitPhoto': pictures
-            }
+            updated_outfit = build_outfit(data, pieces)
 
             # Update the outfit in the database
-            outfits_collection.update_one({'id': id}, {'$set': updated_outfit})
+            outfits_collection.update_one({'owner': owner, 'id': id}, {'$set': updated_outfit})
 
             # Update the rating's pictures
-            ratings_collection.update_one({'id': id}, {'$set': {'pictures': pictures}}, upsert=True)
+            ratings_collection.update_one({'owner': owner, 'id': id},
+                                          {'$set': {'pictures': updated_outfit['outfitPhoto']}}, upsert=True)
+            bump_versions(owner, 'Outfits', 'Ratings')
+            update_outfit_index(owner, upserted=[dict(updated_outfit, id=id)])
 
             return {'Outfit updated successfully!': id}, 200
 
         except Exception as e:
             return {'Invalid JSON file': str(e)}, 422
 
+class PieceOutfits(Resource):
+    @cached_response('Outfits')
+    def get(self, id):
+        # Find all outfits using the piece through the index on pieceIds, optionally of a given style
+        query = {'owner': current_owner(), 'pieceIds': id}
+        if request.args.get('style'):
+            query['style'] = request.args['style']
+
+        try:
+            outfits, limit = find_page(outfits_collection, query, request.args)
+        except ValueError as e:
+            return {'message': f'Bad request: {e}'}, 400
+        outfits, headers = read_page(outfits, limit)
+
+        if not outfits:
+            return {'message': 'Not Found: no outfits matching the criteria found'}, 404
+
+        # Return the list of matching outfits
+        return outfits, 200, headers
+
+
 class Ratings(Resource):
+    @cached_response('Ratings')
     def get(self):
-        ratings = list(ratings_collection.find({}, {'_id': 0}))
-        return ratings, 200
+        try:
+            ratings, limit = find_page(ratings_collection, {'owner': current_owner()}, request.args)
+        except ValueError as e:
+            return {'message': f'Bad request: {e}'}, 400
+        if wants_ndjson():
+            return stream_ndjson(ratings, rating_summary)
+        ratings, headers = read_page(ratings, limit, rating_summary)
+        return ratings, 200, headers
     
 class RatingsId(Resource):
+    @cached_response('Ratings')
     def get(self, id):
         # Find the rating by its ID
-        rating = ratings_collection.find_one({'id': id}, {'_id': 0})
+        rating = ratings_collection.find_one({'owner': current_owner(), 'id': id}, HIDDEN_FIELDS)
         if rating:
-            return rating, 200
+            return rating_summary(rating), 200
         else:
             return {'message': 'Not Found: outfit not found'}, 404
 
@@ -502,20 +2057,32 @@ class RatingsId(Resource):
 
             score = data.get('score')
 
-            if not 0 <= score <= 10:
+            if isinstance(score, bool) or not 0 <= score <= 10:
                 return {'message': 'Unprocessable entity: A score should be a in the range 0 to 10 integer'}, 422
-            
-            # Check if the outfit exists
+
+            # Update the aggregates and the average atomically in a single write
+            bucket = str(int(score))
+            owner = current_owner()
             result = ratings_collection.find_one_and_update(
-                {'id': id},
-                {'$push': {'scores': data['score']}},
+                {'owner': owner, 'id': id},
+                [
+                    {'$set': {
+                        'count': {'$add': [{'$ifNull': ['$count', 0]}, 1]},
+                        'sum': {'$add': [{'$ifNull': ['$sum', 0]}, score]},
+                        'sumSquares': {'$add': [{'$ifNull': ['$sumSquares', 0]}, score * score]},
+                        'histogram.' + bucket: {'$add': [{'$ifNull': ['$histogram.' + bucket, 0]}, 1]}
+                    }},
+                    {'$set': {'average': {'$divide': ['$sum', '$count']}}}
+                ],
+                projection={'_id': 0, 'average': 1},
                 return_document=pymongo.ReturnDocument.AFTER
             )
-            # Calculate the average score
+            # Check if the outfit exists
             if result:
-                avg = sum(result['scores']) / len(result['scores'])
-                ratings_collection.update_one({'id': id}, {'$set': {'average': avg}})
-                return {'Current average': avg}, 201
+                if LOG_RATING_SCORES:
+                    rating_scores_collection.insert_one({'owner': owner, 'id': id, 'score': score})
+                bump_versions(owner, 'Ratings')
+                return {'Current average': result['average']}, 201
             else:
                 return {'message': 'Not Found: outfit not found'}, 404
         except Exception as e:
@@ -523,29 +2090,60 @@ class RatingsId(Resource):
         
     def delete(self, id):
         # Find the rating by its ID
-        delete_rating_result = ratings_collection.delete_one({'id': id})
+        owner = current_owner()
+        delete_rating_result = ratings_collection.delete_one({'owner': owner, 'id': id})
         if delete_rating_result.deleted_count == 0:
             return {'message': 'Ratings not found'}, 404
+        rating_scores_collection.delete_many({'owner': owner, 'id': id})
+        bump_versions(owner, 'Ratings')
         return {'message': 'Ratings successfully deleted', 'id': id}, 200
 
+def rating_summary(rating):
+    """
+    Derives the average and variance of a rating from its running aggregates.
+    """
+    count = rating.get('count', 0)
+    total = rating.pop('sum', None)
+    sum_squares = rating.pop('sumSquares', None)
+    if count and total is not None:
+        average = total / count
+        rating['average'] = average
+        if sum_squares is not None:
+            rating['variance'] = max(sum_squares / count - average ** 2, 0)
+    return rating
+
+
 class TopOutfits(Resource):
+    # The leaderboards stay cached until a rating changes
+    @cached_response('Ratings')
     def get(self):
-        # Compute the top-rated outfits dynamically
-        top_outfits = self.compute_top_outfits()
-
-        if top_outfits:
-            return top_outfits, 200
-        else:
-            return [], 200
-
-    def compute_top_outfits(self):
-        ratings = list(ratings_collection.find({'scores': {'$exists': True, '$not': {'$size': 0}}}))
-        sorted_ratings = sorted(ratings, key=lambda x: x['average'], reverse=True)
-        # Get the top 3 outfits
-        top_outfits = sorted_ratings[:3]
-        if len(sorted_ratings) > 3:
+        try:
+            k = int(request.args.get('k', TOP_OUTFITS_DEFAULT_K))
+            min_votes = int(request.args.get('minVotes', 1))
+        except ValueError:
+            return {'message': 'Bad request: k and minVotes should be integers'}, 400
+        if not 1 <= k <= TOP_OUTFITS_MAX_K or min_votes < 1:
+            return {'message': f'Bad request: k should be between 1 and {TOP_OUTFITS_MAX_K} and minVotes at least 1'}, 400
+
+        # Compute the top-rated outfits
+        top_outfits = self.compute_top_outfits(current_owner(), k, min_votes)
+        return top_outfits, 200
+
+    def compute_top_outfits(self, owner, k=TOP_OUTFITS_DEFAULT_K, min_votes=1):
+        # Get the top k outfits of the owner using the index on (owner, average)
+        query = {'owner': owner, 'count': {'$gte': min_votes}}
+        projection = {'_id': 0, 'id': 1, 'average': 1, 'pictures': 1}
+        top_outfits = list(ratings_collection.find(query, projection).sort('average', pymongo.DESCENDING).limit(k))
+
+        # Outfits tied with the last one are included too
+        if len(top_outfits) == k:
             threshold_average = top_outfits[-1]['average']
-            additional_outfits = [r for r in sorted_ratings[3:] if r['average'] == threshold_average]
+            additional_outfits = ratings_collection.find({
+                'owner': owner,
+                'average': threshold_average,
+                'count': {'$gte': min_votes},
+                'id': {'$nin': [outfit['id'] for outfit in top_outfits]}
+            }, projection)
             top_outfits.extend(additional_outfits)
 
         result = [{
@@ -556,8 +2154,437 @@ class TopOutfits(Resource):
         return result
 
 
+def export_collections():
+    return {'clothes': clothes_collection, 'outfits': outfits_collection, 'ratings': ratings_collection}
+
+
+def export_closet(owner):
+    """
+    Yields the records of the owner's closet, read with batched cursors so the closet is never held in memory.
+    """
+    for name, collection in export_collections().items():
+        for document in collection.find({'owner': owner}, HIDDEN_FIELDS, batch_size=EXPORT_BATCH_SIZE):
+            yield {'collection': name, 'document': document}
+
+
+def encode_records(records, export_format):
+    for record in records:
+        yield bson.encode(record) if export_format == 'bson' else dumps_json(record) + b'\n'
+
+
+def decode_records(stream, export_format):
+    """
+    Reads the records of a binary stream one at a time.
+    """
+    if export_format == 'bson':
+        yield from bson.decode_file_iter(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ClosetImport:
+    """
+    Writes the records of an export into the closet of an owner, in rounds of IMPORT_BATCH_SIZE records.
+    Every document is upserted on (owner, id), so an interrupted import can be run again.
+    Each round writes its pieces, then its outfits, then its ratings, and an outfit (a rating) is only written
+    when all its pieces (its outfit) are in the closet, checked with one query per round. So the records have to
+    come in export order: a piece before the outfits using it, an outfit before its rating.
+    """
+    def __init__(self, owner, batch_size=None):
+        self.owner = owner
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.batches = {name: [] for name in EXPORT_COLLECTIONS}
+        self.counts = {name: {'imported': 0, 'failed': 0} for name in EXPORT_COLLECTIONS}
+        self.records = 0
+        self.errors = []
+        self.error_count = 0
+
+    def run(self, records):
+        """
+        Imports the records and yields a progress report after every round, the last one has 'done': True.
+        A record that can't be decoded ends the import, the report then has an 'error'.
+        """
+        error = None
+        try:
+            for record in records:
+                self.records += 1
+                name = record.get('collection') if isinstance(record, dict) else None
+                document = record.get('document') if name else None
+                if name not in self.batches or not isinstance(document, dict):
+                    self.fail(name, None, 'Unprocessable entity: records should be {"collection": "clothes", '
+                                          '"outfits" or "ratings", "document": {...}}')
+                    continue
+                self.batches[name].append(document)
+                if sum(len(batch) for batch in self.batches.values()) >= self.batch_size:
+                    self.flush()
+                    yield self.report()
+        except (ValueError, bson.errors.BSONError) as e:
+            error = f'Bad request: invalid record after {self.records} records: {e}'
+
+        self.flush()
+        report = self.report(done=True)
+        report['errors'] = self.errors
+        if error:
+            report['error'] = error
+        yield report
+
+    def report(self, done=False):
+        return dict(self.counts, records=self.records, failed=self.error_count, done=done)
+
+    def fail(self, name, document_id, error):
+        if name in self.counts:
+            self.counts[name]['failed'] += 1
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'collection': name, 'id': document_id, 'error': error})
+
+    def flush(self):
+        written = [name for name in EXPORT_COLLECTIONS if self.write(name)]
+        if written:
+            bump_versions(self.owner, *[name.capitalize() for name in written])
+
+    def write(self, name):
+        """
+        Upserts the pending documents of a collection with one bulk write, returns whether any was written.
+        """
+        documents, self.batches[name] = self.batches[name], []
+        documents = [document for document in documents if self.check(name, document)]
+        if documents and name != 'clothes':
+            # The pieces of the outfits (the outfits of the ratings) must already be in the closet
+            parent_collection = clothes_collection if name == 'outfits' else outfits_collection
+            parent_ids = {parent_id for document in documents for parent_id in self.parent_ids(name, document)}
+            existing = {parent['id'] for parent in parent_collection.find(
+                {'owner': self.owner, 'id': {'$in': list(parent_ids)}}, {'_id': 0, 'id': 1})}
+            missing = [document for document in documents if not set(self.parent_ids(name, document)) <= existing]
+            for document in missing:
+                self.fail(name, document['id'], 'Unprocessable entity: ' +
+                          ('unknown pieces' if name == 'outfits' else 'unknown outfit'))
+            documents = [document for document in documents if set(self.parent_ids(name, document)) <= existing]
+        if not documents:
+            return False
+
+        writes = [pymongo.ReplaceOne({'owner': self.owner, 'id': document['id']},
+                                     dict(document, owner=self.owner), upsert=True) for document in documents]
+        failed = set()
+        try:
+            export_collections()[name].bulk_write(writes, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for write_error in e.details['writeErrors']:
+                failed.add(write_error['index'])
+                if write_error['code'] == 11000:
+                    self.fail(name, documents[write_error['index']]['id'],
+                              'Unprocessable entity: Duplicate photo URL. Each clothing item must be unique.')
+                else:
+                    self.fail(name, documents[write_error['index']]['id'],
+                              f"Unprocessable entity: {write_error['errmsg']}")
+        self.counts[name]['imported'] += len(documents) - len(failed)
+
+        # Pieces restored before their photo was checked go back to the validation queue
+        if name == 'clothes' and ASYNC_PHOTO_VALIDATION:
+            for index, document in enumerate(documents):
+                if index not in failed and document.get('validation') == 'pending':
+                    photo_validation_queue.enqueue(self.owner, document['id'], document['photo'])
+        return len(failed) < len(documents)
+
+    def check(self, name, document):
+        document.pop('_id', None)
+        document.pop('owner', None)
+        if not isinstance(document.get('id'), str) or not document['id']:
+            self.fail(name, None, 'Unprocessable entity: missing id')
+            return False
+        error = None
+        if name == 'clothes':
+            try:
+                error = validate_piece(document)
+            except Exception as e:
+                error = f'Unprocessable entity: {e}'
+        elif name == 'outfits':
+            piece_ids = document.get('pieceIds')
+            if not isinstance(piece_ids, list) or not piece_ids \
+                    or not all(isinstance(piece_id, str) for piece_id in piece_ids):
+                error = 'Unprocessable entity: pieceIds must be a non-empty list of piece ids'
+        if error:
+            self.fail(name, document['id'], error)
+        return not error
+
+    @staticmethod
+    def parent_ids(name, document):
+        return document['pieceIds'] if name == 'outfits' else [document['id']]
+
+
+class Export(Resource):
+    def get(self):
+        # The format comes from ?format= or the Accept header, NDJSON by default
+        export_format = request.args.get('format')
+        if export_format is None:
+            export_format = 'bson' if EXPORT_FORMATS['bson'] in request.headers.get('Accept', '') else 'ndjson'
+        if export_format not in EXPORT_FORMATS:
+            return {'message': f'Bad request: format should be one of {list(EXPORT_FORMATS)}'}, 400
+
+        owner = current_owner()
+        return Response(encode_records(export_closet(owner), export_format), mimetype=EXPORT_FORMATS[export_format])
+
+
+class Import(Resource):
+    def post(self):
+        formats = {mimetype: export_format for export_format, mimetype in EXPORT_FORMATS.items()}
+        export_format = formats.get(request.mimetype)
+        if export_format is None:
+            return {'error': f'Unsupported Media Type: Only {list(formats)} are supported.'}, 415
+
+        # The body is decoded while it's received, the records are never all held in memory
+        progress = ClosetImport(current_owner()).run(decode_records(request.stream, export_format))
+
+        # NDJSON clients get a progress report after every round of writes
+        if wants_ndjson():
+            return Response(stream_with_context(dumps_json(report) + b'\n' for report in progress),
+                            mimetype='application/x-ndjson')
+
+        for report in progress:
+            pass
+        return report, 400 if 'error' in report else 200
+
+
+class Liveness(Resource):
+    def get(self):
+        # The process answers, restarting it wouldn't help when only MongoDB is down
+        return {'status': 'alive'}, 200
+
+
+class Readiness(Resource):
+    def get(self):
+        try:
+            client.admin.command('ping')
+        except Exception as e:
+            return {'status': 'unavailable', 'error': str(e)}, 503
+        return {'status': 'ready'}, 200
+
+
+class WeatherCacheStats(Resource):
+    def get(self):
+        return dict(weather_cache.stats(), prefetch=weather_prefetcher.stats()), 200
+
+
+class Metrics(Resource):
+    def get(self):
+        """
+        Exposes the metrics in the Prometheus text format, along with the hits and misses of the caches.
+        """
+        caches = {
+            'response': response_cache,
+            'weather': weather_cache,
+            'location': location_cache,
+            'url_validation': url_validation_cache,
+            'piece_scores': piece_scores_cache,
+        }
+        for name, cache in caches.items():
+            stats = cache.stats()
+            labels = (('cache', name),)
+            metrics.set('closet_cache_hits_total', labels, stats['hits'], kind='counter')
+            metrics.set('closet_cache_misses_total', labels, stats['misses'], kind='counter')
+            metrics.set('closet_cache_size', labels, stats['size'])
+            metrics.set('closet_cache_bytes', labels, stats['bytes'])
+        if OUTFIT_INDEX:
+            for name, value in outfit_index.stats().items():
+                metrics.set(f'closet_outfit_index_{name}', (), value)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def weather_bucket(latitude, longitude):
+    """
+    Round a location to its weather cache bucket, nearby users share the same bucket.
+    """
+    return round(float(latitude), WEATHER_BUCKET_DIGITS), round(float(longitude), WEATHER_BUCKET_DIGITS)
 
+
+@instrument_call('call', 'fetch_weather', failed=lambda result: result[1] is None)
 def fetch_weather(self, latitude, longitude):
+    """
+    Returns the (should_be_waterproof, weather) pair for the given location.
+    Results are cached per location bucket for WEATHER_CACHE_TTL seconds, so only
+    the first request of a bucket goes to OpenWeatherMap.
+    """
+    try:
+        bucket = weather_bucket(latitude, longitude)
+    except (TypeError, ValueError):
+        return None, None
+
+    cached = weather_cache.get(bucket)
+    if cached is not None:
+        weather, fetched_at = cached
+        refreshing = weather_prefetcher.track(bucket, fetched_at)
+        # Past the TTL the weather is stale, it's only served while the prefetcher is going to refresh it
+        if refreshing or time.monotonic() - fetched_at < WEATHER_CACHE_TTL:
+            return weather
+
+    # Concurrent misses on the same bucket share a single upstream request
+    weather, fetched_at = weather_flight.do(bucket, refresh_weather, self, bucket)
+    if weather[1] is not None:
+        weather_prefetcher.track(bucket, fetched_at, request=cached is None)
+    return weather
+
+
+def refresh_weather(self, bucket):
+    """
+    Fetches the weather of a bucket from OpenWeatherMap and caches it, returns it with the time it was fetched.
+    """
+    fetched_at = time.monotonic()
+    weather = fetch_weather_from_api(self, *bucket)
+    # Only successful lookups are cached, failures are retried on the next request
+    if weather[1] is not None:
+        weather_cache.set(bucket, (weather, fetched_at))
+    return weather, fetched_at
+
+
+class WeatherPrefetcher:
+    """
+    Refreshes in the background the weather of the buckets this worker is asked for the most, before it expires,
+    so requests rarely wait for OpenWeatherMap. Each refresh is due at a random point of WEATHER_PREFETCH_WINDOW
+    of the TTL, so buckets fetched together don't expire (and aren't refreshed) together.
+    Request counts are halved every WEATHER_PREFETCH_DECAY_INTERVAL seconds and buckets no longer requested are
+    dropped. When max_locations buckets are tracked, a new one only replaces a bucket requested once at most.
+    The refreshes are capped at calls_per_minute, the most requested due buckets first, a due bucket left out
+    is throttled until its weather is fetched again.
+    """
+    def __init__(self, max_locations, calls_per_minute):
+        self.max_locations = max_locations
+        self.calls_per_minute = calls_per_minute
+        self.refreshes = 0
+        self.failures = 0
+        self.throttled = 0
+        self._buckets = {}
+        self._calls = deque()  # times of the upstream calls of the last minute
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def track(self, bucket, fetched_at, request=True):
+        """
+        Counts a request for the bucket, whose cached weather was fetched at fetched_at (time.monotonic()).
+        Returns whether the bucket is tracked and not throttled, i.e. whether its weather is going to be refreshed.
+        """
+        if self._thread is None:
+            return False
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if entry is None:
+                if len(self._buckets) >= self.max_locations:
+                    coldest = min(self._buckets, key=lambda key: self._buckets[key]['requests'])
+                    if self._buckets[coldest]['requests'] > 1:
+                        return False
+                    del self._buckets[coldest]
+                entry = self._buckets[bucket] = {'requests': 0, 'fetched_at': None, 'due_at': None,
+                                                 'throttled': False}
+            if request:
+                entry['requests'] += 1
+            if entry['fetched_at'] is None or fetched_at > entry['fetched_at']:
+                entry['fetched_at'] = fetched_at
+                entry['due_at'] = self.schedule(fetched_at)
+                entry['throttled'] = False
+            return not entry['throttled']
+
+    @staticmethod
+    def schedule(fetched_at):
+        return fetched_at + WEATHER_CACHE_TTL * random.uniform(*WEATHER_PREFETCH_WINDOW)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None,
+                'tracked': len(self._buckets),
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'throttled': self.throttled
+            }
+
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='weather-prefetch', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._buckets.clear()
+        if thread:
+            self._stop.set()
+            thread.join()
+
+    def _run(self):
+        decay_at = time.monotonic() + WEATHER_PREFETCH_DECAY_INTERVAL
+        while not self._stop.wait(WEATHER_PREFETCH_TICK):
+            now = time.monotonic()
+            if now >= decay_at:
+                self._decay()
+                decay_at = now + WEATHER_PREFETCH_DECAY_INTERVAL
+            due = self._due(now)
+            for index, bucket in enumerate(due):
+                if not self._reserve_call(now):
+                    self.throttled += 1
+                    metrics.inc('closet_weather_prefetch_total', (('result', 'throttled'),))
+                    self._throttle(due[index:])
+                    break
+                self._refresh(bucket)
+
+    def _decay(self):
+        with self._lock:
+            for bucket, entry in list(self._buckets.items()):
+                entry['requests'] //= 2
+                if not entry['requests']:
+                    del self._buckets[bucket]
+
+    def _due(self, now):
+        with self._lock:
+            due = [(entry['requests'], bucket) for bucket, entry in self._buckets.items() if entry['due_at'] <= now]
+        return [bucket for _, bucket in sorted(due, reverse=True)]
+
+    def _throttle(self, buckets):
+        with self._lock:
+            for bucket in buckets:
+                entry = self._buckets.get(bucket)
+                if entry:
+                    entry['throttled'] = True
+
+    def _reserve_call(self, now):
+        while self._calls and self._calls[0] <= now - 60:
+            self._calls.popleft()
+        if len(self._calls) >= self.calls_per_minute:
+            return False
+        self._calls.append(now)
+        return True
+
+    def _refresh(self, bucket):
+        try:
+            weather, fetched_at = weather_flight.do(bucket, refresh_weather, None, bucket)
+        except Exception as e:
+            print(f"Error prefetching the weather of {bucket}: {e}")
+            weather, fetched_at = (None, None), None
+
+        with self._lock:
+            entry = self._buckets.get(bucket)
+            if weather[1] is None:
+                self.failures += 1
+                if entry:
+                    entry['due_at'] = time.monotonic() + WEATHER_PREFETCH_RETRY * random.uniform(1, 1.5)
+            else:
+                self.refreshes += 1
+                if entry and fetched_at > entry['fetched_at']:
+                    entry['fetched_at'] = fetched_at
+                    entry['due_at'] = self.schedule(fetched_at)
+                    entry['throttled'] = False
+        metrics.inc('closet_weather_prefetch_total', (('result', 'failed' if weather[1] is None else 'refreshed'),))
+
+
+weather_prefetcher = WeatherPrefetcher(WEATHER_PREFETCH_MAX_LOCATIONS, WEATHER_PREFETCH_CALLS_PER_MINUTE)
+
+
+@instrument_call('dependency', 'openweathermap', failed=lambda result: result[1] is None)
+def fetch_weather_from_api(self, latitude, longitude):
     """
     Fetch current weather data from OpenWeatherMap based on latitude and longitude.
     Returns both the weather condition (e.g., "Rain", "Clear") and the temperature.
@@ -569,7 +2596,7 @@ def fetch_weather(self, latitude, longitude):
             'appid': OPENWEATHER_API_KEY,
             'units': 'metric'  # celsius
         }
-        response = requests.get(OPENWEATHER_URL, params=params)
+        response = http_session.get(OPENWEATHER_URL, params=params, timeout=HTTP_TIMEOUT)
         # Check if the request was successful
         if response.ok:
             should_be_waterproof = False
@@ -595,49 +2622,353 @@ def match_temp_to_outfit(self, temperature):
     return weather_condition
 
 
-def get_location_from_ip(self):
+class GeoIPDatabase:
+    """
+    Offline IP geolocation database loaded from a CSV file.
+    Networks are kept as sorted integer ranges so a lookup is a single binary search.
+    """
+    def __init__(self, path):
+        ranges = {4: [], 6: []}
+        with open(path, newline='') as db_file:
+            for row in csv.DictReader(db_file):
+                if not row.get('latitude') or not row.get('longitude'):
+                    continue
+                network = ipaddress.ip_network(row['network'], strict=False)
+                ranges[network.version].append((int(network.network_address), int(network.broadcast_address),
+                                                 row['latitude'], row['longitude']))
+        self._starts = {}
+        self._ranges = {}
+        for version, version_ranges in ranges.items():
+            version_ranges.sort()
+            self._starts[version] = [start for start, _, _, _ in version_ranges]
+            self._ranges[version] = version_ranges
+
+    def lookup(self, ip):
+        address = ipaddress.ip_address(ip)
+        index = bisect_right(self._starts[address.version], int(address)) - 1
+        if index < 0:
+            return None
+        _, end, latitude, longitude = self._ranges[address.version][index]
+        if int(address) > end:
+            return None
+        return latitude, longitude
+
+
+geoip_db = GeoIPDatabase(GEOIP_DB_PATH) if GEOIP_DB_PATH else None
+location_cache = TTLCache(GEOIP_CACHE_SIZE, GEOIP_CACHE_TTL)
+location_flight = SingleFlight()
+
+
+def get_client_ip():
+    """
+    Returns the address of the caller. Behind TRUSTED_PROXY_COUNT proxies it's the X-Forwarded-For entry
+    appended by the outermost one, the entries on its left come from the caller and aren't trusted.
+    """
+    forwarded_for = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')]
+    if TRUSTED_PROXY_COUNT and len(forwarded_for) >= TRUSTED_PROXY_COUNT and forwarded_for[-TRUSTED_PROXY_COUNT]:
+        return forwarded_for[-TRUSTED_PROXY_COUNT]
+    return request.remote_addr
+
+
+def ip_prefix(ip):
+    """
+    Returns the network prefix an IP address is cached under,
+    or None for private and loopback addresses that can't be geolocated.
+    """
+    address = ipaddress.ip_address(ip)
+    if not address.is_global:
+        return None
+    prefix_length = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network(f'{ip}/{prefix_length}', strict=False))
+
+
+@instrument_call('call', 'get_location_from_ip', failed=lambda result: result is None)
+def get_location_from_ip(self, ip=None):
     """
     Fetch the user's location (latitude and longitude) based on their IP address.
-    Uses the ipinfo.io service to retrieve geolocation data.
+    The offline database is tried first, then ipinfo.io with results cached per prefix.
+    Private addresses (e.g. local development) resolve to the server's own location.
+    """
+    try:
+        prefix = ip_prefix(ip) if ip else None
+    except ValueError:
+        prefix = None
+
+    if prefix and geoip_db:
+        location = geoip_db.lookup(ip)
+        if location:
+            return location
+
+    cache_key = prefix or 'self'
+    location = location_cache.get(cache_key)
+    if location is not None:
+        return location
+
+    def fetch_and_cache():
+        location = fetch_location_from_api(self, ip if prefix else None)
+        if location:
+            location_cache.set(cache_key, location)
+        return location
+
+    # Concurrent misses on the same prefix share a single upstream request
+    return location_flight.do(cache_key, fetch_and_cache)
+
+
+@instrument_call('dependency', 'ipinfo', failed=lambda result: result is None)
+def fetch_location_from_api(self, ip=None):
+    """
+    Fetch the location of the given IP address (or of the server when ip is None)
+    using the ipinfo.io service.
     """
     try:
-        response = requests.get(IPINFO_URL)
+        response = http_session.get(IPINFO_IP_URL.format(ip) if ip else IPINFO_URL, timeout=HTTP_TIMEOUT)
         if response.ok:
             location_data = response.json()
             # The 'loc' field contains "latitude,longitude"
-            latitude, llongitudeon = location_data['loc'].split(',')
-            return latitude, llongitudeon
+            latitude, longitude = location_data['loc'].split(',')
+            return latitude, longitude
         else:
             return None
     except Exception as e:
         return None
 
-def is_valid_url(url):
+def validate_piece(data):
+    """
+    Checks the fields of a new clothing piece, returns an error message or None if it's valid.
+    """
+    # Check if there's a missing field
+    if not all(field in data for field in ['type', 'color', 'photo']):
+        return 'Unprocessable entity: Missing required fields'
+
+    if not data['type'].split() or not data['color'].split() \
+            or not data['photo'].split():
+        return 'Unprocessable entity: Empty fields are not accepted'
+
+    # Check for invalid type
+    if data['type'] not in ACCEPTED_TYPES:
+        return 'Unprocessable entity: Invalid type value'
+
+    return None
+
+
+url_validation_cache = TTLCache(URL_CACHE_SIZE, URL_VALID_TTL)
+
+
+@instrument_call('call', 'is_valid_url')
+def is_valid_url(url, check_remote=True):
     """
     Validates if the given URL is properly formatted and points to a valid image.
+    Remote results are cached, pass check_remote=False (or set SKIP_URL_VALIDATION)
+    to only validate the URL format.
     """
     try:
         parsed = urlparse(url)
         if not all([parsed.scheme, parsed.netloc]):  # Basic URL format validation
             return False
-        
-        # Check if the URL points to an image
-        response = requests.get(url, timeout=5, stream=True)
-        content_type = response.headers.get('Content-Type', '').lower()
-        if response.status_code == 200 and 'image' in content_type:
-            return True
     except Exception as e:
         print(f"Error validating URL: {e}")
-    
-    return False
+        return False
+
+    if not check_remote or SKIP_URL_VALIDATION:
+        return True
+
+    cached = url_validation_cache.get(url)
+    if cached is not None:
+        return cached
+
+    valid = is_image_url(url)
+    url_validation_cache.set(url, valid, ttl=URL_VALID_TTL if valid else URL_INVALID_TTL)
+    return valid
+
+
+def is_image_url(url):
+    """
+    Checks that the URL points to an image, a host that can't be reached counts as an invalid URL.
+    """
+    return check_image_url(url) is True
+
+
+@instrument_call('dependency', 'image_host', failed=lambda result: result is None)
+def check_image_url(url):
+    """
+    Checks that the URL points to an image with a HEAD request,
+    falling back to fetching only the first byte for hosts that don't answer HEAD properly.
+    Returns None when the answer may change on a retry (host unreachable, 429 or 5xx).
+    """
+    try:
+        with image_session.head(url, timeout=URL_VALIDATION_TIMEOUT, allow_redirects=True) as response:
+            if response.status_code == 200 and 'image' in response.headers.get('Content-Type', '').lower():
+                return True
+            if response.status_code in (404, 410):
+                return False
+
+        with image_session.get(url, timeout=URL_VALIDATION_TIMEOUT, stream=True,
+                               headers={'Range': 'bytes=0-0'}) as response:
+            if response.status_code == 429 or response.status_code >= 500:
+                return None
+            content_type = response.headers.get('Content-Type', '').lower()
+            return response.status_code in (200, 206) and 'image' in content_type
+    except Exception as e:
+        print(f"Error validating URL: {e}")
+
+    return None
+
+
+class PhotoValidationQueue:
+    """
+    Validates in the background the photos of the pieces added or changed in async mode.
+    The jobs live in the PhotoValidations collection so they survive restarts. A poller thread claims
+    the due jobs by pushing their runAt forward (a lease, the job comes back if its worker dies)
+    and runs them on a pool of threads. Unreachable photos are retried with exponential backoff.
+    """
+    def __init__(self, workers, poll_interval):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._slots = threading.Semaphore(workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, owner, piece_id, photo):
+        # A piece has at most one job, a new photo replaces the job of the previous one
+        photo_validations_collection.update_one(
+            {'owner': owner, 'pieceId': piece_id},
+            {'$set': {'photo': photo, 'runAt': time.time(), 'attempts': 0}},
+            upsert=True
+        )
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        with self._lock:
+            if self._thread:
+                return
+            self._stop.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._thread = threading.Thread(target=self._poll, name='photo-validation', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if not self._thread:
+                return
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+            self._thread = None
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self._slots.acquire()
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming a photo validation: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                if not ASYNC_PHOTO_VALIDATION and self._stop_when_drained():
+                    return
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._executor.submit(self._run, job)
+
+    def resume(self):
+        """
+        Starts the poller of a process in async mode, or when jobs were left in the queue by an earlier run.
+        """
+        if ASYNC_PHOTO_VALIDATION or photo_validations_collection.find_one({}, {'_id': 1}) is not None:
+            self.start()
+
+    def _stop_when_drained(self):
+        # Outside async mode the poller only runs until the queue is empty, enqueue starts it again.
+        # Jobs are deleted once done, so an empty queue also means no job is running.
+        # The lock isn't waited for, stop() holds it while it joins this thread.
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if photo_validations_collection.find_one({}, {'_id': 1}) is not None:
+                return False
+            self._executor.shutdown(wait=False)
+            self._thread = None
+            return True
+        finally:
+            self._lock.release()
+
+    def _claim(self):
+        now = time.time()
+        return photo_validations_collection.find_one_and_update(
+            {'runAt': {'$lte': now}},
+            {'$set': {'runAt': now + PHOTO_VALIDATION_LEASE}, '$inc': {'attempts': 1}},
+            sort=[('runAt', pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    def _run(self, job):
+        try:
+            self.validate(job)
+        except Exception as e:
+            # The lease expires and another attempt picks the job up
+            print(f"Error validating photo: {e}")
+        finally:
+            self._slots.release()
+
+    def validate(self, job):
+        owner = job.get('owner', DEFAULT_OWNER)
+        photo = job['photo']
+        valid = url_validation_cache.get(photo)
+        if valid is None:
+            valid = check_image_url(photo)
+
+        if valid is None and job['attempts'] < PHOTO_VALIDATION_MAX_ATTEMPTS:
+            # Retry later, the filter on photo leaves alone a job replaced by a newer photo meanwhile
+            delay = min(PHOTO_VALIDATION_BACKOFF * 2 ** (job['attempts'] - 1), PHOTO_VALIDATION_MAX_BACKOFF)
+            photo_validations_collection.update_one(
+                {'owner': owner, 'pieceId': job['pieceId'], 'photo': photo},
+                {'$set': {'runAt': time.time() + delay * random.uniform(0.5, 1)}}
+            )
+            return
+
+        valid = bool(valid)
+        url_validation_cache.set(photo, valid, ttl=URL_VALID_TTL if valid else URL_INVALID_TTL)
+        result = clothes_collection.update_one(
+            {'owner': owner, 'id': job['pieceId'], 'photo': photo, 'validation': 'pending'},
+            {'$set': {'validation': 'valid' if valid else 'invalid'}}
+        )
+        photo_validations_collection.delete_one({'owner': owner, 'pieceId': job['pieceId'], 'photo': photo})
+        if result.modified_count:
+            bump_versions(owner, 'Clothes')
+
+
+photo_validation_queue = PhotoValidationQueue(PHOTO_VALIDATION_WORKERS, PHOTO_VALIDATION_POLL_INTERVAL)
 
 api.add_resource(Clothes, "/clothes")
+api.add_resource(ClothesBulk, "/clothes/bulk")
+api.add_resource(ClothesSearch, "/clothes/search")
 api.add_resource(FilteredClothes, "/clothes/<string:id>")
+api.add_resource(PieceOutfits, "/clothes/<string:id>/outfits")
 api.add_resource(Outfits, "/outfits")
+api.add_resource(OutfitsValidate, "/outfits/validate")
+api.add_resource(OutfitsGenerate, "/outfits/generate")
 api.add_resource(FilteredOutfit, "/outfits/<string:id>")
 api.add_resource(RatingsId, "/ratings/<string:id>")
 api.add_resource(Ratings, "/ratings")
 api.add_resource(TopOutfits, "/top")
-
+api.add_resource(Export, "/export")
+api.add_resource(Import, "/import")
+api.add_resource(WeatherCacheStats, "/weather/cache")
+api.add_resource(Metrics, "/metrics")
+api.add_resource(Liveness, "/health/live")
+api.add_resource(Readiness, "/health/ready")
+
+# Development server only, production runs gunicorn with gunicorn.conf.py
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    prepare_database()
+    photo_validation_queue.resume()
+    if WEATHER_PREFETCH:
+        weather_prefetcher.start()
+    app.run(host="0.0.0.0", port=env_int('PORT', 5000), debug=env_bool('FLASK_DEBUG', False))
@@ -0,0 +1,48 @@
+"""
+Gunicorn settings of the production server, every value can be overridden with an environment variable.
+Run with: gunicorn --config gunicorn.conf.py closet:app
+"""
+import multiprocessing
+import os
+import sys
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# Pre-fork workers, each serving requests on a pool of threads
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+# Workers stuck longer than timeout are restarted, on SIGTERM the in-flight requests get graceful_timeout to finish
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('WEB_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # Indexes and migrations run once in the master, before any worker serves requests
+    import closet
+    closet.prepare_database()
+    closet.client.close()
+
+
+def post_fork(server, worker):
+    # The client inherited from the master can't be used after the fork, each worker opens its own pool
+    closet = sys.modules.get('closet')
+    if closet:
+        closet.connect_database()
+        # Resume the photo validations left in the queue
+        closet.photo_validation_queue.resume()
+        # Each worker keeps the weather of its own cache fresh
+        if closet.WEATHER_PREFETCH:
+            closet.weather_prefetcher.start()
+
+
+def worker_exit(server, worker):
+    closet = sys.modules.get('closet')
+    if closet:
+        closet.shutdown()
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import closet  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """
+    Test client of the app on an in-process mongomock database.
+    mongomock has no transactions and its bulk writes don't match pymongo's, so the version bumps are skipped.
+    """
+    mongomock = pytest.importorskip('mongomock')
+    database = mongomock.MongoClient()['ClosetTest']
+    for name, collection in [('clothes_collection', 'Clothes'), ('outfits_collection', 'Outfits'),
+                             ('ratings_collection', 'Ratings'), ('rating_scores_collection', 'RatingScores'),
+                             ('versions_collection', 'Versions'), ('photo_validations_collection', 'PhotoValidations')]:
+        monkeypatch.setattr(closet, name, database[collection])
+    closet.response_cache.clear()
+    monkeypatch.setattr(closet, 'bump_versions', lambda owner, *names: None)
+    monkeypatch.setattr(closet, 'is_valid_url', lambda url, check_remote=True: True)
+    return closet.app.test_client()
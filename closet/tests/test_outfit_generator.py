@@ -0,0 +1,95 @@
+import time
+
+from closet import OutfitGenerator, outfit_rules
+
+
+def piece(piece_id, item_type, water_proof=False):
+    return {'id': piece_id, 'type': item_type, 'photo': f'http://x/{piece_id}.png', 'waterProof': water_proof}
+
+
+PIECES = [
+    piece('shirt', 'Shirt'), piece('shirt2', 'Shirt'), piece('dress', 'Dress'),
+    piece('pants', 'Long Pants'), piece('shorts', 'Short Pants'), piece('skirt', 'Skirt'),
+    piece('shoes', 'Shoes'), piece('boots', 'Shoes'),
+    piece('jacket', 'Jacket'), piece('raincoat', 'Jacket', water_proof=True),
+    piece('hat', 'Hat'), piece('glasses', 'SunGlasses'),
+]
+
+
+def generate(pieces=PIECES, scores=None, weather='Mild', waterproof=False, pinned=None, limit=50, budget=5):
+    generator = OutfitGenerator(pieces, scores or {}, weather, waterproof, pinned)
+    return list(generator.generate(limit, time.monotonic() + budget))
+
+
+def ids(outfit_pieces):
+    return {item['id'] for item in outfit_pieces}
+
+
+def test_outfits_are_valid_and_unique():
+    outfits = generate()
+    assert len(outfits) == 50
+    assert all(outfit_rules.check(item['type'] for item in pieces) is None for _, pieces in outfits)
+    assert len({frozenset(ids(pieces)) for _, pieces in outfits}) == len(outfits)
+
+
+def test_outfits_come_best_first():
+    scores = {'shirt2': 3, 'boots': 2, 'skirt': 1, 'shoes': -1}
+    outfits = generate(scores=scores)
+    outfit_scores = [score for score, _ in outfits]
+    assert outfit_scores == sorted(outfit_scores, reverse=True)
+    # The best rated pieces and no unrated extras
+    assert ids(outfits[0][1]) == {'shirt2', 'skirt', 'boots'}
+    assert outfits[0][0] == 6
+
+
+def test_weather_preferences_rank_the_pieces():
+    best = ids(generate(weather='Hot')[0][1])
+    assert 'shorts' in best and 'glasses' in best and 'jacket' not in best
+    assert 'pants' in ids(generate(weather='Cold')[0][1])
+
+
+def test_pinned_piece_is_in_every_outfit():
+    for pinned in (piece('hat', 'Hat'), piece('skirt', 'Skirt'), piece('dress', 'Dress')):
+        outfits = generate(scores={pinned['id']: -5}, pinned=pinned)
+        assert outfits
+        assert all(pinned['id'] in ids(pieces) for _, pieces in outfits)
+
+
+def test_pinned_dress_excludes_shirts_and_bottoms():
+    outfits = generate(pinned=piece('dress', 'Dress'))
+    types = {item['type'] for _, pieces in outfits for item in pieces}
+    assert not types & {'Shirt', 'Long Pants', 'Short Pants', 'Skirt'}
+
+
+def test_rain_requires_a_waterproof_jacket():
+    outfits = generate(waterproof=True)
+    assert outfits
+    for _, pieces in outfits:
+        jackets = [item for item in pieces if item['type'] == 'Jacket']
+        assert [item['id'] for item in jackets] == ['raincoat']
+
+
+def test_rain_without_a_waterproof_jacket_gives_no_outfit():
+    pieces = [item for item in PIECES if item['id'] != 'raincoat']
+    assert generate(pieces, waterproof=True) == []
+
+
+def test_missing_required_slot_gives_no_outfit():
+    assert generate([item for item in PIECES if item['type'] != 'Shoes']) == []
+
+
+def test_limit():
+    assert len(generate(limit=3)) == 3
+
+
+def test_time_budget():
+    # A large closet has far more outfits than can be listed within the budget
+    pieces = [piece(f'{item_type}{index}', item_type) for index in range(30)
+              for item_type in ['Shirt', 'Long Pants', 'Shoes', 'Jacket', 'Hat', 'Bag', 'Belt', 'Scarf']]
+    generator = OutfitGenerator(pieces, {}, 'Mild', False)
+    start = time.monotonic()
+    outfits = list(generator.generate(10 ** 6, start + 0.05))
+    assert time.monotonic() - start < 0.5
+    assert 0 < len(outfits) < 10 ** 6
+
+    assert list(generator.generate(10, time.monotonic() - 1)) == []
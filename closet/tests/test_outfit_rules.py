@@ -0,0 +1,128 @@
+import pytest
+
+import closet
+from closet import outfit_rules, validate_outfit
+
+
+@pytest.mark.parametrize('types, error', [
+    (['Shirt', 'Long Pants', 'Shoes'], None),
+    (['Dress', 'Shoes'], None),
+    (['Shirt', 'Skirt', 'Shoes', 'Jacket', 'Bag', 'Hat', 'Belt', 'Scarf', 'SunGlasses'], None),
+    (['Shirt', 'Long Pants'], 'You should have a pair of shoes!'),
+    (['Long Pants', 'Shoes'], 'You should have at least one top!'),
+    (['Shirt', 'Shoes'], 'You should have at least one bottom!'),
+    (['Shirt', 'Long Pants', 'Skirt', 'Shoes'], 'Too many bottoms!'),
+    (['Dress', 'Skirt', 'Shoes'], 'Too many bottoms!'),
+    (['Dress', 'Shirt', 'Shoes'], 'Too many tops!'),
+    (['Shirt', 'Long Pants', 'Shoes', 'Shoes'], 'Too many Shoess!'),
+    (['Shirt', 'Long Pants', 'Shoes', 'Hat', 'Hat'], 'Too many Hats!'),
+    (['Shirt', 'Long Pants', 'Shoes', 'Jacket', 'Jacket'], 'Too many Jackets!'),
+])
+def test_outfit_rules(types, error):
+    assert outfit_rules.check(types) == error
+
+
+def test_unknown_types_count_for_nothing():
+    assert outfit_rules.check(['Shirt', 'Long Pants', 'Shoes', 'Cape']) is None
+    assert outfit_rules.check(['Cape']) == 'You should have a pair of shoes!'
+
+
+PIECES = {
+    'shirt': {'id': 'shirt', 'type': 'Shirt', 'photo': 'http://x/shirt.png'},
+    'pants': {'id': 'pants', 'type': 'Long Pants', 'photo': 'http://x/pants.png'},
+    'shoes': {'id': 'shoes', 'type': 'Shoes', 'photo': 'http://x/shoes.png'},
+    'hat': {'id': 'hat', 'type': 'Hat', 'photo': 'http://x/hat.png'},
+    'hat2': {'id': 'hat2', 'type': 'Hat', 'photo': 'http://x/hat2.png'},
+}
+
+
+def outfit(**fields):
+    return dict({'style': 'Casual', 'clothingItems': ['shirt', 'pants', 'shoes'], 'suitableWeathers': 'Mild'},
+                **fields)
+
+
+@pytest.mark.parametrize('data, error', [
+    (outfit(), None),
+    ({'style': 'Casual', 'clothingItems': ['shirt', 'pants', 'shoes']}, 'Unprocessable entity: Missing required fields'),
+    (['shirt'], 'Unprocessable entity: Missing required fields'),
+    (outfit(clothingItems=[]), 'Unprocessable entity: clothingItems must contain at least one ID'),
+    (outfit(clothingItems=['shirt', 'pants', 'unknown']), 'Unprocessable entity: One or more clothing item IDs are invalid'),
+    (outfit(clothingItems='shirt'), 'Unprocessable entity: One or more clothing item IDs are invalid'),
+    (outfit(clothingItems=['shirt', 'pants', 'shoes', 'shoes']),
+     'Unprocessable entity: One or more clothing item IDs are invalid'),
+    (outfit(clothingItems=['shirt', 'pants', 'shoes', 'hat', 'hat2']), 'Too many Hats!'),
+    (outfit(clothingItems=['shirt', 'pants']), 'You should have a pair of shoes!'),
+    (outfit(style='Formal'), 'Unprocessable entity: Invalid style value'),
+    (outfit(suitableWeathers='Rainy'), 'Unprocessable entity: Invalid weather value'),
+])
+def test_validate_outfit(data, error):
+    assert validate_outfit(data, PIECES) == error
+
+
+def test_rules_are_checked_before_style_and_weather():
+    data = outfit(clothingItems=['shirt', 'pants'], style='Formal', suitableWeathers='Rainy')
+    assert validate_outfit(data, PIECES) == 'You should have a pair of shoes!'
+
+
+def test_weather_preferences_use_accepted_types():
+    for preferences in closet.WEATHER_PREFERENCES.values():
+        assert set(preferences) <= set(closet.ACCEPTED_TYPES)
+
+
+def add_piece(client, item_type, name, water_proof=False):
+    response = client.post('/clothes', json={'type': item_type, 'color': 'red', 'waterProof': water_proof,
+                                             'photo': f'http://x/{name}.png'})
+    assert response.status_code == 201
+    return response.get_json()['created']
+
+
+@pytest.fixture
+def closet_pieces(client):
+    return {
+        'shirt': add_piece(client, 'Shirt', 'shirt'),
+        'pants': add_piece(client, 'Long Pants', 'pants'),
+        'skirt': add_piece(client, 'Skirt', 'skirt'),
+        'shoes': add_piece(client, 'Shoes', 'shoes'),
+        'jacket': add_piece(client, 'Jacket', 'jacket', water_proof=True),
+        'hat': add_piece(client, 'Hat', 'hat'),
+        'hat2': add_piece(client, 'Hat', 'hat2'),
+    }
+
+
+@pytest.mark.parametrize('names, fields', [
+    (['shirt', 'pants'], {}),
+    (['shirt', 'pants', 'skirt', 'shoes'], {}),
+    (['shirt', 'pants', 'shoes', 'hat', 'hat2'], {}),
+    (['shirt', 'pants', 'shoes', 'shoes'], {}),
+    (['shirt', 'pants', 'shoes', 'missing'], {}),
+    ([], {}),
+    (['shirt', 'pants', 'shoes'], {'style': 'Formal'}),
+    (['shirt', 'pants', 'shoes'], {'suitableWeathers': 'Rainy'}),
+])
+def test_post_and_put_reject_the_same_outfits(client, closet_pieces, names, fields):
+    valid = outfit(clothingItems=[closet_pieces[name] for name in ['shirt', 'pants', 'shoes']])
+    outfit_id = list(client.post('/outfits', json=valid).get_json().values())[0]
+
+    data = outfit(clothingItems=[closet_pieces.get(name, name) for name in names], **fields)
+    posted = client.post('/outfits', json=data)
+    put = client.put(f'/outfits/{outfit_id}', json=data)
+    assert posted.status_code == put.status_code == 422
+    assert posted.get_json() == put.get_json()
+
+    # The rejected update left the outfit unchanged
+    assert client.get(f'/outfits/{outfit_id}').get_json()['pieceIds'] == valid['clothingItems']
+
+
+def test_post_and_put_store_the_same_outfit(client, closet_pieces):
+    first = outfit(clothingItems=[closet_pieces[name] for name in ['shirt', 'pants', 'shoes']])
+    second = outfit(clothingItems=[closet_pieces[name] for name in ['shirt', 'skirt', 'shoes', 'jacket', 'hat']],
+                    style='Work', suitableWeathers='Cold')
+    posted_id = list(client.post('/outfits', json=second).get_json().values())[0]
+    put_id = list(client.post('/outfits', json=first).get_json().values())[0]
+    assert client.put(f'/outfits/{put_id}', json=second).status_code == 200
+
+    posted = client.get(f'/outfits/{posted_id}').get_json()
+    put = client.get(f'/outfits/{put_id}').get_json()
+    assert posted.pop('id') == posted_id and put.pop('id') == put_id
+    assert posted == put
+    assert posted['waterproof'] is True